@@ -1,39 +1,99 @@
-from six import PY2
+import bisect
+import functools
+import os
+import re
+from collections import OrderedDict
+
+from six import PY2, string_types
 
 from procmon_parser.configuration import *
 from procmon_parser.configuration_format import load_configuration, loads_configuration, dump_configuration, \
     dumps_configuration
+from procmon_parser.index import load_index
 from procmon_parser.logs import *
-from procmon_parser.stream_logs_format import PMLStreamReader
+from procmon_parser.parallel import summarize_event, parallel_read_events
+from procmon_parser.stream_logs_format import PMLStreamReader, Header
 
 __all__ = [
-    'ProcmonLogsReader', 'load_configuration', 'loads_configuration', 'dump_configuration', 'dumps_configuration',
-    'Rule', 'Column', 'RuleAction', 'RuleRelation', 'PMLError'
+    'ProcmonLogsReader', 'ProcmonLogSetReader', 'load_configuration', 'loads_configuration', 'dump_configuration',
+    'dumps_configuration', 'Rule', 'Column', 'RuleAction', 'RuleRelation', 'PMLError'
 ]
 
+# The default of the initial value of ``ProcmonLogsReader.parallel_reduce``, because None can be an initial value
+_NO_INITIAL = object()
+
 
 class ProcmonLogsReader(object):
     """Reads procmon logs from a stream which in the PML format
     """
 
-    def __init__(self, f, should_get_stacktrace=True, should_get_details=True):
-        """Build a ProcmonLogsReader object from ``f`` (a `.read()``-supporting file-like object).
-        :param f: ``read`` supporting file-like object
+    def __init__(self, f, should_get_stacktrace=True, should_get_details=True, backend="stream", lazy=False,
+                 where=None, filter_rules=None, intern_stacktraces=False, compact=False, index=False):
+        """Build a ProcmonLogsReader object from ``f`` (a `.read()``-supporting file-like object or a path).
+        :param f: ``read`` supporting file-like object, or the path to the PML file.
         :param should_get_stacktrace: True if the parser should parse the stack traces
         :param should_get_details: True if the parser should parse the Detail column information of the event.
+        :param backend: "stream" to read the file with seek() and read() calls, "mmap" to memory map the file and
+        parse it without copying (requires a real file or an in-memory stream like BytesIO), or "pread" to read the
+        events with os.pread (requires a real file, and falls back to "mmap" where os.pread is missing, like on
+        Windows). With "mmap" and "pread", random access to the events is safe from multiple threads.
+        :param lazy: True to read only the common fields of the events, and decode the path, category, details and
+        stack trace of an event on their first access (see ``LazyEvent``).
+        :param where: a filter of the iterated events by their fixed fields, like
+        ``{"event_class": EventClass.Registry, "pid": {1234, 5678}, "result": 0}``. The events that don't match are
+        skipped before their stack trace and details are read. Indexing the reader is not filtered.
+        :param filter_rules: a list of ``Rule`` objects (like the "FilterRules" of a PMC configuration) that the
+        iterated events should pass, like in Procmon.
+        :param intern_stacktraces: True to share one tuple between identical stack traces, and keep them in the
+        ``stacktraces`` table of the reader, which is safe to share between threads. Otherwise every stack trace is
+        an array of the frame addresses.
+        :param compact: True to read the events as ``CompactEvent`` objects, which take a lot less memory when many
+        events are kept. Can't be used with ``lazy``.
+        :param index: True to use the sidecar index of the file ("Log.pmlidx" for "Log.PML"), or the path of the index
+        file. The index is built if it is missing or if the file changed since it was built. Then the offsets of the
+        events, the ``where`` filter, ``scan_columns`` and ``index_at_time`` use the index instead of scanning the file
+        (see ``PMLIndex``). Requires numpy, and the reader to be created from the path of the PML file.
+        """
+        self._file = None
+        self._path = getattr(f, 'name', None)
+        if not hasattr(f, 'read'):
+            self._path = f
+            f = self._file = open(f, "rb")
+        self._reader_kwargs = dict(should_get_stacktrace=should_get_stacktrace, should_get_details=should_get_details,
+                                   backend=backend, lazy=lazy, where=where, filter_rules=filter_rules,
+                                   intern_stacktraces=intern_stacktraces, compact=compact)
+        try:
+            pml_index = None
+            if index:
+                if not isinstance(self._path, string_types):
+                    raise ValueError("The index requires the reader to be created from the path of the PML file")
+                pml_index = load_index(self._path, None if index is True else index)
+            self._struct_readear = PMLStreamReader(f, index=pml_index, **self._reader_kwargs)
+        except Exception:
+            if self._file is not None:
+                self._file.close()
+            raise
+        self._events = iter(self._struct_readear)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Release the resources of the reader, and close the file if it was opened by the reader.
         """
-        self._struct_readear = PMLStreamReader(f, should_get_stacktrace, should_get_details)
-        self._current_event_index = 0
+        self._struct_readear.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self._current_event_index >= self.__len__():
-            raise StopIteration
-        current_index = self._current_event_index
-        self._current_event_index += 1
-        return self[current_index]
+        return next(self._events)
 
     if PY2:
         next = __next__
@@ -44,17 +104,215 @@ class ProcmonLogsReader(object):
     def __len__(self):
         return self._struct_readear.number_of_events
 
+    def parallel_iter(self, workers=None, chunk_size=10000, map_fn=None, reduce_fn=None, compact=False):
+        """Iterate over the events with a pool of worker processes, in the original order of the events.
+        The reader must be created from a path or from a file object of a real file, which every worker opens again.
+
+        :param workers: number of worker processes, the number of CPUs by default.
+        :param chunk_size: number of events in every task of a worker.
+        :param map_fn: a function that is applied to every event in the workers, so only its results are sent back.
+        :param reduce_fn: a function of two mapped values that combines them, applied to every chunk in its worker.
+        Then only one partial result per chunk is yielded (use ``parallel_reduce`` to get the total).
+        :param compact: send back a picklable ``EventSummary`` of every event instead of the full Event objects.
+        """
+        if not isinstance(self._path, string_types):
+            raise ValueError("Parallel parsing requires the reader to be created from the path of the PML file")
+        if compact:
+            if map_fn is not None:
+                raise ValueError("map_fn can't be used with compact results")
+            map_fn = summarize_event
+        return parallel_read_events(self._path, len(self), self._reader_kwargs, workers, chunk_size, map_fn,
+                                    reduce_fn)
+
+    def parallel_reduce(self, map_fn, reduce_fn, workers=None, chunk_size=10000, initial=_NO_INITIAL):
+        """Map every event and reduce the results with a pool of worker processes, see ``parallel_iter``.
+        ``reduce_fn`` is applied both in the workers and to their partial results, so it should be associative.
+        :param initial: the value that the partial results are reduced into, which is also the result when there are
+        no events. Without it, reducing no events raises ValueError.
+        """
+        partial_results = self.parallel_iter(workers, chunk_size, map_fn, reduce_fn)
+        if initial is _NO_INITIAL:
+            initial = next(partial_results, _NO_INITIAL)
+            if initial is _NO_INITIAL:
+                raise ValueError("There are no events to reduce, and no initial value")
+        return functools.reduce(reduce_fn, partial_results, initial)
+
+    @property
+    def index(self):
+        """The ``PMLIndex`` of the file, or None if the reader doesn't use an index.
+        """
+        return self._struct_readear.index
+
+    @property
+    def stacktraces(self):
+        """The ``StacktraceTable`` of the distinct stack traces of the read events, if they are interned.
+        """
+        return self._struct_readear.stacktraces
+
+    def index_at_time(self, filetime):
+        """Get the index of the first event that happened at ``filetime`` (a FILETIME value or a datetime in UTC) or
+        after it, with a binary search over the dates of the events.
+        """
+        return self._struct_readear.index_at_time(filetime)
+
+    def time_range(self, start, end):
+        """Iterate over the events that happened from ``start`` until ``end``, without reading the events before them.
+        """
+        return self._struct_readear.time_range(start, end)
+
     def processes(self):
         """Return a list of all the known processes in the log file
         """
         return self._struct_readear.processes()
 
+    def scan_columns(self, columns=None):
+        """Read the common fields of all the events (like pid, tid, operation and date) as numpy arrays, without
+        parsing the events themselves. Requires numpy.
+        """
+        return self._struct_readear.scan_columns(columns)
+
     def system_details(self):
         """Return the system details of the computer which captured the logs (like Tools -> System Details in Procmon)
         """
         return self._struct_readear.system_details()
 
 
+def get_linked_pml_paths(pml_path):
+    """Get the paths of the PML files of a capture that Procmon split into linked files, like "Log.PML",
+    "Log-1.PML", "Log-2.PML" and so on, in their order.
+    """
+    directory, filename = os.path.split(pml_path)
+    base, extension = os.path.splitext(filename)
+    linked_filename_pattern = re.compile(re.escape(base) + r"-(\d+)" + re.escape(extension) + "$")
+    linked_paths = []
+    for linked_filename in os.listdir(directory or os.curdir):
+        match = linked_filename_pattern.match(linked_filename)
+        if match:
+            linked_paths.append((int(match.group(1)), os.path.join(directory, linked_filename)))
+    return [pml_path] + [path for _, path in sorted(linked_paths)]
+
+
+class ProcmonLogSetReader(object):
+    """Reads the linked PML files of a capture (like "Log.PML", "Log-1.PML", "Log-2.PML") as a single log.
+
+    Only the headers of the files are read up front, to know the number of events in every file. The files are opened
+    when their events are read, and at most ``max_open_files`` of them are kept open, besides the files that are being
+    iterated.
+    The same process in different files is represented by the same Process object.
+    """
+
+    def __init__(self, pml_path, max_open_files=16, **reader_kwargs):
+        """
+        :param pml_path: the path of the first PML file of the capture, or a list of the paths of the PML files.
+        :param max_open_files: maximum number of files that are kept open at the same time.
+        :param reader_kwargs: keyword arguments for the ``ProcmonLogsReader`` of every file. Note that lazy events
+        can only be loaded while their file is open, otherwise they raise ``PMLError``.
+        """
+        if max_open_files < 1:
+            raise ValueError("max_open_files must be at least 1")
+        self._paths = get_linked_pml_paths(pml_path) if isinstance(pml_path, string_types) else list(pml_path)
+        self._max_open_files = max_open_files
+        self._reader_kwargs = reader_kwargs
+        self._readers = OrderedDict()  # the open readers, from the least recently used
+        self._iterated_files = {}  # file index to the number of iterations over the file, which keep it open
+        self._known_processes = {}
+
+        # The index of the first event of every file, and the total number of events at the end
+        self._first_indexes = [0]
+        for path in self._paths:
+            with open(path, "rb") as f:
+                self._first_indexes.append(self._first_indexes[-1] + Header(f).number_of_events)
+        self._events = None
+
+    @property
+    def paths(self):
+        return list(self._paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close all the open files.
+        """
+        while self._readers:
+            _, reader = self._readers.popitem()
+            reader.close()
+
+    def _get_reader(self, file_index):
+        """Get the reader of a file, and open it if it is not open yet.
+        """
+        reader = self._readers.pop(file_index, None)
+        if reader is None:
+            reader = ProcmonLogsReader(self._paths[file_index], **self._reader_kwargs)
+            reader._struct_readear.share_processes(self._known_processes)
+        self._readers[file_index] = reader
+        self._close_unused_readers(file_index)
+        return reader
+
+    def _close_unused_readers(self, used_file_index=None):
+        """Close the least recently used readers while there are too many open files, except the files that are being
+        iterated and the file that is being used.
+        """
+        unused_file_indexes = [i for i in self._readers if i not in self._iterated_files and i != used_file_index]
+        for file_index in unused_file_indexes[:max(0, len(self._readers) - self._max_open_files)]:
+            self._readers.pop(file_index).close()
+
+    def __len__(self):
+        return self._first_indexes[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Event index out of range")
+        file_index = bisect.bisect_right(self._first_indexes, index) - 1
+        return self._get_reader(file_index)[index - self._first_indexes[file_index]]
+
+    def iter_events(self):
+        """Iterate over the events of all the files in order, with the filters of the readers.
+        """
+        for file_index in range(len(self._paths)):
+            if self._first_indexes[file_index + 1] > self._first_indexes[file_index]:
+                reader = self._get_reader(file_index)
+                self._iterated_files[file_index] = self._iterated_files.get(file_index, 0) + 1
+                try:
+                    for event in iter(reader._struct_readear):
+                        yield event
+                finally:
+                    self._iterated_files[file_index] -= 1
+                    if not self._iterated_files[file_index]:
+                        del self._iterated_files[file_index]
+                    self._close_unused_readers()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._events is None:
+            self._events = self.iter_events()
+        return next(self._events)
+
+    if PY2:
+        next = __next__
+
+    def processes(self):
+        """Return a list of all the known processes in the log files. This opens all the files.
+        """
+        for file_index in range(len(self._paths)):
+            self._get_reader(file_index)
+        return list(self._known_processes.values())
+
+    def system_details(self):
+        """Return the system details of the computer which captured the logs
+        """
+        return self._get_reader(0).system_details()
+
+
 def read_all_events_from_pml(file):
     """
     Helper function that reads all the events from a PML file.
@@ -3,7 +3,8 @@ Python types for constant values in Procmon
 """
 
 import enum
-from collections import OrderedDict
+import functools
+from collections import OrderedDict, namedtuple
 
 
 class RuleAction(enum.IntEnum):
@@ -488,6 +489,78 @@ _ErrorCodeMessages = {
 }
 
 
+FormatterCacheInfo = namedtuple('FormatterCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+FORMATTER_CACHE_SIZE = 4096  # the maximum number of values in the cache of a memoized formatter
+
+# The memoized formatters by their name
+MEMOIZED_FORMATTERS = OrderedDict()
+
+
+def memoized_formatter(function):
+    """Decorator of a function that formats a value (like an access mask or an error code) to a string, which keeps the
+    strings of the values that were already formatted.
+
+    A log has only a few hundred distinct values of every kind, so when the cache is full the new values are just
+    formatted without being cached. Like ``functools.lru_cache``, the formatter has ``cache_info()`` and
+    ``cache_clear()``, and ``warm(values)`` formats and caches values ahead of time.
+    """
+    cache = {}
+    stats = [0, 0]  # the hits and the misses
+
+    @functools.wraps(function)
+    def formatter(value):
+        try:
+            result = cache[value]
+        except KeyError:
+            stats[1] += 1
+            result = function(value)
+            if len(cache) < FORMATTER_CACHE_SIZE:
+                cache[value] = result
+            return result
+        stats[0] += 1
+        return result
+
+    def warm(values):
+        for value in values:
+            if len(cache) >= FORMATTER_CACHE_SIZE:
+                break
+            if value not in cache:
+                cache[value] = function(value)
+
+    def cache_clear():
+        cache.clear()
+        stats[:] = [0, 0]
+
+    formatter.cache_info = lambda: FormatterCacheInfo(stats[0], stats[1], FORMATTER_CACHE_SIZE, len(cache))
+    formatter.cache_clear = cache_clear
+    formatter.warm = warm
+    MEMOIZED_FORMATTERS[function.__name__] = formatter
+    return formatter
+
+
+def get_formatters_cache_info():
+    """Return a dictionary of the name of every memoized formatter to the statistics of its cache.
+    """
+    return OrderedDict((name, formatter.cache_info()) for name, formatter in MEMOIZED_FORMATTERS.items())
+
+
+def clear_formatters_caches():
+    for formatter in MEMOIZED_FORMATTERS.values():
+        formatter.cache_clear()
+
+
+def warm_formatters_caches(values_by_formatter):
+    """Format and cache values ahead of time, like the values that were seen in a previous log.
+
+    :param values_by_formatter: a dictionary of the name of a memoized formatter (like "get_ioctl_name") to a
+    collection of values.
+    """
+    for name, values in values_by_formatter.items():
+        MEMOIZED_FORMATTERS[name].warm(values)
+
+
+@memoized_formatter
 def get_error_message(error_value):
     return _ErrorCodeMessages.get(error_value, "0x{:X}".format(error_value))
 
@@ -578,10 +651,12 @@ def _get_access_mask_string(access_mask, mappings, access_strings):
     return string
 
 
+@memoized_formatter
 def get_registry_access_mask_string(access_mask):
     return _get_access_mask_string(access_mask, REGISTRY_ACCESS_MASK_MAPPING, REGISTRY_ACCESS_MASK_STRINGS)
 
 
+@memoized_formatter
 def get_filesystem_access_mask_string(access_mask):
     return _get_access_mask_string(access_mask, FILESYSTEM_ACCESS_MASK_MAPPING, FILESYSTEM_ACCESS_MASK_STRINGS)
 
@@ -612,6 +687,7 @@ FILESYSTEM_CREATE_OPTIONS = OrderedDict([
 ])
 
 
+@memoized_formatter
 def get_filesysyem_create_options(options_mask):
     return _get_mask_string(options_mask, FILESYSTEM_CREATE_OPTIONS, ", ")
 
@@ -635,6 +711,7 @@ FilesystemCreateAttributes = OrderedDict([
 ])
 
 
+@memoized_formatter
 def get_filesysyem_create_attributes(create_mask):
     if 0 == create_mask:
         return "n/a"
@@ -648,6 +725,7 @@ FilesystemCreateShareMode = OrderedDict([
 ])
 
 
+@memoized_formatter
 def get_filesysyem_create_share_mode(share_mask):
     if 0 == share_mask:
         return "None"
@@ -664,6 +742,7 @@ FilesystemIoFlags = OrderedDict([
 ])
 
 
+@memoized_formatter
 def get_filesysyem_io_flags(flags):
     return _get_mask_string(flags, FilesystemIoFlags, ", ")
 
@@ -1039,6 +1118,7 @@ _IoctlConsts = {
 }
 
 
+@memoized_formatter
 def get_ioctl_name(ioctl):
     try:
         return _IoctlConsts[ioctl]
@@ -1143,6 +1223,7 @@ FilesystemNotifyChangeFlags = OrderedDict([
 ])
 
 
+@memoized_formatter
 def get_filesystem_notify_change_flags(flags):
     return _get_mask_string(flags, FilesystemNotifyChangeFlags, ", ")
 
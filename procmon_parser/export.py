@@ -0,0 +1,392 @@
+"""
+Exporting the events of a PML file to other formats
+"""
+
+import csv
+import itertools
+import os
+import sqlite3
+from collections import OrderedDict, defaultdict
+
+from six import PY2, text_type
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow is an optional dependency, only needed for the Arrow and Parquet export
+    pyarrow = None
+
+from procmon_parser.consts import Column, ColumnToOriginalName
+from procmon_parser.filters import PROCESS_COLUMNS
+from procmon_parser.logs import COMPATIBLE_CSV_COLUMN_GETTERS
+
+__all__ = ['FOLDED_STACKS_WEIGHTS', 'fold_stacks', 'write_folded_stacks', 'ARROW_COLUMNS', 'iter_record_batches',
+           'to_parquet', 'SQLITE_SCHEMA', 'SQLITE_INDEXES', 'to_sqlite', 'CSV_COLUMNS', 'write_csv']
+
+
+SYSTEM_PID = 4  # the System process, which has the kernel modules
+
+# How much every event adds to the weight of its stack
+FOLDED_STACKS_WEIGHTS = {
+    "count": lambda event: 1,
+    "duration": lambda event: event.duration,
+}
+
+
+def fold_stacks(reader, weight="count"):
+    """Aggregate the stack traces of the events of a log, for a flame graph.
+
+    The events are streamed from the reader and only the distinct stack traces of every process are kept, so the memory
+    doesn't grow with the number of events. Every distinct stack trace is symbolized once at the end. Events without a
+    stack trace are skipped.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader`` (with the filters of the events to include).
+    :param weight: "count" to count the events of every stack, or "duration" to sum their duration (in 100ns units).
+    :return: a dictionary of the folded stack ("process.exe;root frame;...;leaf frame") to its weight.
+    """
+    if weight not in FOLDED_STACKS_WEIGHTS:
+        raise ValueError("Unknown weight \"{}\", expected one of {}".format(
+            weight, ", ".join(sorted(FOLDED_STACKS_WEIGHTS))))
+    get_weight = FOLDED_STACKS_WEIGHTS[weight]
+
+    processes = {}
+    stack_weights = defaultdict(int)  # the (id of the process, stack trace) to its weight
+    for event in reader:
+        stacktrace = event.stacktrace
+        if not stacktrace:
+            continue
+        process = event.process
+        processes[id(process)] = process
+        key = (id(process), stacktrace if isinstance(stacktrace, tuple) else tuple(stacktrace))
+        stack_weights[key] += get_weight(event)
+
+    system_process = next((p for p in reader.processes() if p.pid == SYSTEM_PID), None)
+    folded_stacks = defaultdict(int)
+    for (process_id, stacktrace), stack_weight in stack_weights.items():
+        process = processes[process_id]
+        frames = process.symbolize(stacktrace, fallback=system_process)
+        frames.reverse()  # the first frame of a stack trace is the innermost one
+        folded_stacks[u";".join([process.process_name] + frames)] += stack_weight
+    return dict(folded_stacks)
+
+
+def write_folded_stacks(reader, stream, weight="count"):
+    """Write the folded stacks of the events of a log (see ``fold_stacks``) to a text stream, in the format of
+    Brendan Gregg's FlameGraph scripts: every line is a folded stack and its weight.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader``.
+    :param stream: a text stream to write to.
+    :param weight: "count" or "duration".
+    """
+    for folded_stack, stack_weight in sorted(fold_stacks(reader, weight).items()):
+        stream.write(u"{} {}\n".format(folded_stack, stack_weight))
+
+
+# The columns of the Arrow and Parquet export: the name of the type of the column (see ``_arrow_type``) and a function
+# of an event that returns its value. The strings that repeat a lot are dictionary encoded, the dates are FILETIME
+# values and the durations are in 100ns units.
+ARROW_COLUMNS = OrderedDict([
+    ("process_name", ("dictionary", lambda event: event.process.process_name)),
+    ("pid", ("uint32", lambda event: event.process.pid)),
+    ("tid", ("uint32", lambda event: event.tid)),
+    ("event_class", ("dictionary", lambda event: event.event_class.name)),
+    ("operation", ("dictionary", lambda event: event.operation)),
+    ("date_filetime", ("int64", lambda event: event.date_filetime)),
+    ("duration", ("uint64", lambda event: event.duration)),
+    ("result", ("uint32", lambda event: event.result)),
+    ("category", ("dictionary", lambda event: event.category)),
+    ("path", ("dictionary", lambda event: event.path)),
+    ("details", ("map", lambda event: [(text_type(k), text_type(v)) for k, v in event.details.items()])),
+])
+
+# The columns that are exported by default, the details are exported only when asked for
+DEFAULT_ARROW_COLUMNS = [name for name in ARROW_COLUMNS if name != "details"]
+
+
+def _arrow_type(type_name):
+    if type_name == "dictionary":
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    if type_name == "map":
+        return pyarrow.map_(pyarrow.string(), pyarrow.string())
+    return getattr(pyarrow, type_name)()
+
+
+def _arrow_schema(columns):
+    """Get the names of the exported columns and the Arrow schema of the export.
+    """
+    if pyarrow is None:
+        raise ImportError("The Arrow and Parquet export requires pyarrow")
+    columns = DEFAULT_ARROW_COLUMNS if columns is None else list(columns)
+    for column in columns:
+        if column not in ARROW_COLUMNS:
+            raise ValueError("Unknown column \"{}\", expected one of {}".format(column, ", ".join(ARROW_COLUMNS)))
+    return columns, pyarrow.schema([(column, _arrow_type(ARROW_COLUMNS[column][0])) for column in columns])
+
+
+def _arrow_array(type_name, values):
+    if type_name == "dictionary":
+        return pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+    return pyarrow.array(values, type=_arrow_type(type_name))
+
+
+def iter_record_batches(reader, columns=None, batch_size=0x10000):
+    """Convert the events of a log to Arrow record batches of typed columns. Only one batch of events is kept at a
+    time, so the memory doesn't grow with the number of events. Requires pyarrow.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader`` (with the filters of the events to include).
+    :param columns: names of the columns from ``ARROW_COLUMNS``. By default all of them except "details".
+    :param batch_size: number of events in every record batch.
+    """
+    columns, schema = _arrow_schema(columns)
+    events = iter(reader)
+    while True:
+        batch = list(itertools.islice(events, batch_size))
+        if not batch:
+            break
+        arrays = []
+        for column in columns:
+            type_name, get_value = ARROW_COLUMNS[column]
+            arrays.append(_arrow_array(type_name, [get_value(event) for event in batch]))
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def to_parquet(reader, path, columns=None, row_group_size=0x10000):
+    """Write the events of a log to a Parquet file, one row group at a time (see ``iter_record_batches``).
+    Requires pyarrow.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader``.
+    :param path: the path of the Parquet file, or a binary stream to write to.
+    :param columns: names of the columns from ``ARROW_COLUMNS``. By default all of them except "details".
+    :param row_group_size: number of events in every row group.
+    :return: the number of written events.
+    """
+    columns, schema = _arrow_schema(columns)
+    number_of_events = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in iter_record_batches(reader, columns, row_group_size):
+            writer.write_batch(batch, row_group_size=row_group_size)
+            number_of_events += batch.num_rows
+    return number_of_events
+
+
+# The normalized schema of the SQLite export. The repeating strings of the events (like the operations and the paths)
+# are interned in the strings table, and the distinct stack traces in the stack_frames table. SQLite integers are
+# signed, so the unsigned 64-bit values (like kernel addresses) are stored in two's complement.
+SQLITE_SCHEMA = """
+CREATE TABLE processes (
+    id INTEGER PRIMARY KEY, pid INTEGER, parent_pid INTEGER, process_name TEXT, image_path TEXT, command_line TEXT,
+    user TEXT, company TEXT, version TEXT, description TEXT, integrity TEXT, session INTEGER,
+    authentication_id INTEGER, virtualized INTEGER, is_process_64bit INTEGER, start_time INTEGER, end_time INTEGER
+);
+CREATE TABLE modules (
+    id INTEGER PRIMARY KEY, process_id INTEGER REFERENCES processes(id), base_address INTEGER, size INTEGER,
+    path TEXT, version TEXT, company TEXT, description TEXT, timestamp INTEGER
+);
+CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT);
+CREATE TABLE stack_frames (stacktrace_id INTEGER, frame_index INTEGER, address INTEGER);
+CREATE TABLE events (
+    id INTEGER PRIMARY KEY, process_id INTEGER REFERENCES processes(id), tid INTEGER,
+    event_class_id INTEGER REFERENCES strings(id), operation_id INTEGER REFERENCES strings(id),
+    date_filetime INTEGER, duration INTEGER, result INTEGER, category_id INTEGER REFERENCES strings(id),
+    path_id INTEGER REFERENCES strings(id), stacktrace_id INTEGER
+);
+CREATE VIEW events_view AS
+    SELECT events.id, processes.process_name, processes.pid, events.tid, event_class.value AS event_class,
+           operation.value AS operation, events.date_filetime, events.duration, events.result,
+           category.value AS category, path.value AS path, events.stacktrace_id
+    FROM events
+    JOIN processes ON processes.id = events.process_id
+    JOIN strings AS event_class ON event_class.id = events.event_class_id
+    JOIN strings AS operation ON operation.id = events.operation_id
+    JOIN strings AS category ON category.id = events.category_id
+    JOIN strings AS path ON path.id = events.path_id;
+"""
+
+# The indexes are created after all the rows are inserted, which is a lot faster than updating them on every insert
+SQLITE_INDEXES = """
+CREATE UNIQUE INDEX strings_value ON strings(value);
+CREATE INDEX modules_process_id ON modules(process_id);
+CREATE INDEX stack_frames_stacktrace_id ON stack_frames(stacktrace_id, frame_index);
+CREATE INDEX events_process_id ON events(process_id);
+CREATE INDEX events_operation_id ON events(operation_id);
+CREATE INDEX events_path_id ON events(path_id);
+CREATE INDEX events_date_filetime ON events(date_filetime);
+"""
+
+SQLITE_PROCESS_FIELDS = ("pid", "parent_pid", "process_name", "image_path", "command_line", "user", "company",
+                         "version", "description", "integrity", "session", "authentication_id", "virtualized",
+                         "is_process_64bit", "start_time", "end_time")
+
+
+def _to_signed64(value):
+    return value - 0x10000000000000000 if value >= 0x8000000000000000 else value
+
+
+def _process_key(process):
+    """The key of a process, which is the same in every process that parses the log (see ``share_processes``).
+    """
+    return process.pid, process.parent_pid, process.start_time, process.image_path
+
+
+def _sqlite_event_row(event):
+    """Get the fields of an event for the SQLite export, before its strings and its stack trace are interned.
+    This is the map function of the worker process of ``to_sqlite``, so it is cheap to pickle.
+    """
+    return (_process_key(event.process), event.tid, event.event_class.name, event.operation, event.date_filetime,
+            event.duration, event.result, event.category, event.path, tuple(event.stacktrace))
+
+
+def _insert_processes(connection, processes):
+    """Insert the processes and their modules, and get a dictionary of the key of a process to its id.
+    """
+    process_ids = {}
+    module_rows = []
+    insert_process = "INSERT INTO processes VALUES ({})".format(", ".join("?" * (len(SQLITE_PROCESS_FIELDS) + 1)))
+    for process_id, process in enumerate(processes, 1):
+        connection.execute(insert_process, [process_id] + [getattr(process, field) for field in SQLITE_PROCESS_FIELDS])
+        module_rows.extend((process_id, _to_signed64(m.base_address), m.size, m.path, m.version, m.company,
+                            m.description, m.timestamp) for m in process.modules)
+        process_ids[_process_key(process)] = process_id
+    connection.executemany("INSERT INTO modules (process_id, base_address, size, path, version, company, description, "
+                           "timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", module_rows)
+    return process_ids
+
+
+def to_sqlite(reader, path, batch_size=0x10000, worker=False, overwrite=False):
+    """Write the processes, the modules and the events of a log with their stack traces to a new SQLite database, in
+    the schema of ``SQLITE_SCHEMA``.
+
+    The events are inserted in batches, with one transaction per batch, and the indexes are created at the end.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader`` (with the filters of the events to include).
+    :param path: the path of the database file.
+    :param batch_size: number of events in every transaction.
+    :param worker: True to parse the events in a worker process, while the database is written by this process. The
+    reader must be a ``ProcmonLogsReader`` that was created from the path of the PML file (see ``parallel_iter``).
+    :param overwrite: True to replace the file at ``path`` if it exists. Otherwise an existing file is an error.
+    :return: the number of written events.
+    """
+    if os.path.exists(path):
+        if not overwrite:
+            raise ValueError("The database \"{}\" already exists, use overwrite=True to replace it".format(path))
+        os.remove(path)
+
+    if worker:
+        rows = reader.parallel_iter(workers=1, chunk_size=batch_size, map_fn=_sqlite_event_row)
+    else:
+        rows = (_sqlite_event_row(event) for event in reader)
+
+    connection = sqlite3.connect(path)
+    try:
+        # The database is built from scratch, so there is no need for a rollback journal or for syncing every write
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(SQLITE_SCHEMA)
+        with connection:
+            process_ids = _insert_processes(connection, reader.processes())
+
+        string_ids = {}
+        stacktrace_ids = {(): None}
+        number_of_events = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            string_rows = []
+            frame_rows = []
+            event_rows = []
+            for process_key, tid, event_class, operation, date, duration, result, category, event_path, stacktrace \
+                    in batch:
+                event_string_ids = []
+                for value in (event_class, operation, category, event_path):
+                    string_id = string_ids.get(value)
+                    if string_id is None:
+                        string_id = string_ids[value] = len(string_ids) + 1
+                        string_rows.append((string_id, value))
+                    event_string_ids.append(string_id)
+                stacktrace_id = stacktrace_ids.get(stacktrace, 0)
+                if stacktrace_id == 0:
+                    stacktrace_id = stacktrace_ids[stacktrace] = len(stacktrace_ids)
+                    frame_rows.extend(zip(itertools.repeat(stacktrace_id), itertools.count(),
+                                          [_to_signed64(address) for address in stacktrace]))
+                number_of_events += 1
+                event_rows.append((number_of_events, process_ids[process_key], tid, event_string_ids[0],
+                                   event_string_ids[1], date, _to_signed64(duration), result, event_string_ids[2],
+                                   event_string_ids[3], stacktrace_id))
+            with connection:
+                connection.executemany("INSERT INTO strings VALUES (?, ?)", string_rows)
+                connection.executemany("INSERT INTO stack_frames VALUES (?, ?, ?)", frame_rows)
+                connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", event_rows)
+
+        connection.executescript(SQLITE_INDEXES)
+        connection.commit()
+    finally:
+        connection.close()
+    return number_of_events
+
+
+# The columns of the CSV that Procmon exports, in their order
+CSV_COLUMNS = [
+    Column.TIME_OF_DAY, Column.PROCESS_NAME, Column.PID, Column.OPERATION, Column.PATH, Column.RESULT, Column.DETAIL,
+    Column.DATE_AND_TIME, Column.RELATIVE_TIME, Column.DURATION, Column.COMPLETION_TIME, Column.EVENT_CLASS,
+    Column.SEQUENCE, Column.IMAGE_PATH, Column.COMPANY, Column.DESCRIPTION, Column.VERSION, Column.USER,
+    Column.AUTHENTICATION_ID, Column.SESSION, Column.COMMAND_LINE, Column.TID, Column.VIRTUALIZED, Column.INTEGRITY,
+    Column.CATEGORY, Column.PARENT_PID, Column.ARCHITECTURE,
+]
+
+
+def write_csv(reader, stream, columns=None, first_event_date_filetime=None, batch_size=0x1000):
+    """Write the events of a log in the CSV format of Procmon, like ``Event.get_compatible_csv_info``.
+
+    Only the given columns are computed. The columns of the process of an event (like the user and the command line)
+    are computed once per process, and the rows are written in batches.
+
+    :param reader: a reader of PML files, like ``ProcmonLogsReader`` (with the filters of the events to include).
+    :param stream: a text stream to write to. In Python 2 it is a binary stream, and the values are written in UTF-8.
+    :param columns: a list of ``Column`` values, ``CSV_COLUMNS`` by default.
+    :param first_event_date_filetime: the date that the relative time of the events is from, by default the date of
+    the first written event.
+    :param batch_size: number of rows in every write.
+    :return: the number of written events.
+    """
+    columns = CSV_COLUMNS if columns is None else list(columns)
+    for column in columns:
+        if column not in COMPATIBLE_CSV_COLUMN_GETTERS:
+            raise ValueError("Can't write the column {} to csv".format(column.name))
+    process_getters = [(i, COMPATIBLE_CSV_COLUMN_GETTERS[c]) for i, c in enumerate(columns) if c in PROCESS_COLUMNS]
+    event_getters = [(i, COMPATIBLE_CSV_COLUMN_GETTERS[c]) for i, c in enumerate(columns) if c not in PROCESS_COLUMNS]
+
+    writer = csv.writer(stream, quoting=csv.QUOTE_ALL)
+    writer.writerow([ColumnToOriginalName[column] for column in columns])
+    process_rows = {}  # the id of a process to the process and a row with the values of its columns
+    rows = []
+    number_of_events = 0
+    for event in reader:
+        if first_event_date_filetime is None:
+            first_event_date_filetime = event.date_filetime
+        process = event.process
+        process_row = process_rows.get(id(process))
+        if process_row is None:
+            process_row = [None] * len(columns)
+            for i, get_value in process_getters:
+                process_row[i] = get_value(event, first_event_date_filetime)
+            process_rows[id(process)] = (process, process_row)  # the process is kept so its id isn't reused
+        else:
+            process_row = process_row[1]
+
+        row = process_row[:]
+        for i, get_value in event_getters:
+            row[i] = get_value(event, first_event_date_filetime)
+        rows.append(row)
+        if len(rows) >= batch_size:
+            _write_csv_rows(writer, rows)
+            number_of_events += len(rows)
+            rows = []
+    _write_csv_rows(writer, rows)
+    return number_of_events + len(rows)
+
+
+def _write_csv_rows(writer, rows):
+    if PY2:
+        rows = [[v.encode("utf-8") if isinstance(v, text_type) else v for v in row] for row in rows]
+    writer.writerows(rows)
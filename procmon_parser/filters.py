@@ -0,0 +1,315 @@
+"""
+Filtering events of a PML file, by the fields of their CommonEventStruct before the rest of the event is parsed, or by
+Procmon filter rules
+"""
+
+import enum
+import re
+
+from six import string_types
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, and only needed for ``where_mask``
+    numpy = None
+
+from procmon_parser.consts import Column, EventClass, EventClassOperation, RuleAction, RuleRelation
+from procmon_parser.logs import COMPATIBLE_CSV_COLUMN_GETTERS, get_compatible_csv_operation_name
+
+__all__ = ['WHERE_FIELDS', 'compile_where', 'where_mask', 'RulesFilter', 'compile_rules']
+
+
+# The fields that can be filtered, and their index in the unpacked CommonEventStruct
+WHERE_FIELDS = {
+    "process_index": 0,
+    "tid": 1,
+    "event_class": 2,
+    "result": 8,
+}
+
+# The event class of every operation enum, for filtering operations given as enum members
+OPERATION_ENUM_TO_EVENT_CLASS = {operation_enum: event_class
+                                 for event_class, operation_enum in EventClassOperation.items()}
+
+
+def _as_values(value):
+    """A filter value is either a single value or a collection of accepted values.
+    """
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return frozenset(value)
+    return frozenset([value])
+
+
+def _operation_keys(operations):
+    """Get the (event class, operation) pairs of the operations, which are enum members (like
+    ``RegistryOperation.RegOpenKey``) or names (like "RegOpenKey").
+    """
+    keys = set()
+    for operation in operations:
+        if isinstance(operation, enum.IntEnum) and type(operation) in OPERATION_ENUM_TO_EVENT_CLASS:
+            keys.add((int(OPERATION_ENUM_TO_EVENT_CLASS[type(operation)]), int(operation)))
+        elif isinstance(operation, string_types):
+            matching_keys = [(int(event_class), int(operation_enum[operation]))
+                             for event_class, operation_enum in EventClassOperation.items()
+                             if operation in operation_enum.__members__]
+            if not matching_keys:
+                raise ValueError("Unknown operation \"{}\"".format(operation))
+            keys.update(matching_keys)
+        else:
+            raise TypeError("An operation should be an operation enum member or its name, got {!r}".format(operation))
+    return frozenset(keys)
+
+
+def _where_checks(where, process_table):
+    """Get the checks of a filter: a list of (field, accepted values) and the accepted (event class, operation) pairs,
+    or None if the operation is not filtered.
+    """
+    checks = []
+    operation_keys = None
+    for field, value in where.items():
+        values = _as_values(value)
+        if field == "pid":
+            checks.append(("process_index",
+                           frozenset(i for i, process in process_table.items() if process.pid in values)))
+        elif field == "event_class":
+            checks.append((field, frozenset(int(EventClass[v] if isinstance(v, string_types) else v) for v in values)))
+        elif field == "operation":
+            operation_keys = _operation_keys(values)
+        elif field in WHERE_FIELDS:
+            checks.append((field, values))
+        else:
+            raise ValueError("Can't filter by \"{}\", expected one of {}".format(
+                field, ", ".join(sorted(list(WHERE_FIELDS) + ["pid", "operation"]))))
+    return checks, operation_keys
+
+
+def compile_where(where, process_table):
+    """Build a predicate that checks the unpacked CommonEventStruct fields of an event against a filter, so events
+    that don't match can be skipped before their stack trace and details are read.
+
+    :param where: a dictionary of field name to the accepted value, or a collection of accepted values. The fields are
+    "pid", "process_index", "tid", "event_class", "operation" (enum members or base operation names) and "result".
+    All the fields must match.
+    :param process_table: dictionary of process index to Process, used for filtering by pid.
+    :return: a function of the CommonEventStruct fields that returns True if the event matches, or None if there is
+    nothing to filter.
+    """
+    if not where:
+        return None
+
+    checks, operation_keys = _where_checks(where, process_table)
+    checks = [(WHERE_FIELDS[field], values) for field, values in checks]
+
+    def predicate(common_fields):
+        for i, values in checks:
+            if common_fields[i] not in values:
+                return False
+        return operation_keys is None or (common_fields[2], common_fields[3]) in operation_keys
+
+    return predicate
+
+
+def where_mask(where, process_table, columns):
+    """Check the fixed fields of all the events against a filter at once, like ``compile_where`` but on the columns of
+    the events. Requires numpy.
+
+    :param where: the filter, see ``compile_where``.
+    :param process_table: dictionary of process index to Process, used for filtering by pid.
+    :param columns: a dictionary of column name to a numpy array with a value for every event, with the
+    "process_index", "tid", "event_class", "operation" and "result" columns (like ``PMLStreamReader.scan_columns``).
+    :return: a numpy array of booleans that is True for the events that match, or None if there is nothing to filter.
+    """
+    if not where:
+        return None
+    if numpy is None:
+        raise ImportError("where_mask requires numpy")
+
+    checks, operation_keys = _where_checks(where, process_table)
+    mask = numpy.ones(len(columns["event_class"]), dtype=bool)
+    for field, values in checks:
+        mask &= numpy.isin(columns[field], numpy.array(sorted(int(v) for v in values), dtype=numpy.int64))
+    if operation_keys is not None:
+        # an (event class, operation) pair as a single number
+        keys = columns["event_class"].astype(numpy.int64) << 16 | columns["operation"]
+        mask &= numpy.isin(keys, numpy.array(sorted(c << 16 | o for c, o in operation_keys), dtype=numpy.int64))
+    return mask
+
+
+# Columns that only depend on the process of the event, so the rules on them are checked once per process
+PROCESS_COLUMNS = (Column.PROCESS_NAME, Column.PID, Column.PARENT_PID, Column.IMAGE_PATH, Column.COMMAND_LINE,
+                   Column.USER, Column.SESSION, Column.INTEGRITY, Column.ARCHITECTURE, Column.AUTHENTICATION_ID,
+                   Column.VIRTUALIZED, Column.COMPANY, Column.DESCRIPTION, Column.VERSION)
+
+# Columns that need the details of the event. Their rules are checked last, so with a lazy event the details are
+# parsed only for the events that pass all the other rules. The operation of some events is refined by the details
+# too, but their rules are usually decided by the names that the operation can have (see ``LazyEvent``).
+DETAIL_COLUMNS = (Column.CATEGORY, Column.PATH, Column.DETAIL)
+
+# The result of the rules on the operation names of a lazy event, when it depends on which of them the event has
+_UNDECIDED = object()
+
+
+def _as_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _compare_matcher(values, is_less_than):
+    """Procmon compares numbers by their value and other strings lexicographically.
+    """
+    numbers = [(v, _as_number(v)) for v in values]
+
+    def match(value):
+        value_number = _as_number(value)
+        for v, v_number in numbers:
+            a, b = (value_number, v_number) if value_number is not None and v_number is not None else (value, v)
+            if (a < b) if is_less_than else (a > b):
+                return True
+        return False
+    return match
+
+
+def _relation_matcher(relation, values):
+    """Build a function of a lowercase column value that returns True if any of the (lowercase) values of the rules
+    with this relation matches it.
+    """
+    if relation == RuleRelation.IS:
+        values = frozenset(values)
+        return values.__contains__
+    elif relation == RuleRelation.IS_NOT:
+        values = frozenset(values)
+        if len(values) > 1:
+            return lambda value: True  # a value can't be equal to all of them
+        return lambda value: value not in values
+    elif relation == RuleRelation.BEGINS_WITH:
+        prefixes = tuple(values)
+        return lambda value: value.startswith(prefixes)
+    elif relation == RuleRelation.ENDS_WITH:
+        suffixes = tuple(values)
+        return lambda value: value.endswith(suffixes)
+    elif relation == RuleRelation.CONTAINS:
+        search = re.compile("|".join(re.escape(v) for v in sorted(values, key=len, reverse=True))).search
+        return lambda value: search(value) is not None
+    elif relation == RuleRelation.EXCLUDES:
+        return lambda value: any(v not in value for v in values)
+    elif relation in (RuleRelation.LESS_THAN, RuleRelation.MORE_THAN):
+        return _compare_matcher(values, relation == RuleRelation.LESS_THAN)
+    raise ValueError("Unknown rule relation {}".format(relation))
+
+
+def _column_matcher(rules):
+    """Build a function of a column value that returns True if any of the rules matches it, with a single check for
+    all the rules of the same relation. Like in Procmon the values are compared case insensitively.
+    """
+    values_by_relation = {}
+    for rule in rules:
+        values_by_relation.setdefault(rule.relation, []).append(rule.value.lower())
+    matchers = [_relation_matcher(relation, values) for relation, values in values_by_relation.items()]
+    if len(matchers) == 1:
+        matcher = matchers[0]
+        return lambda value: matcher(value.lower())
+    return lambda value: any(matcher(value.lower()) for matcher in matchers)
+
+
+class RulesFilter(object):
+    """Matches events against Procmon filter rules, like the FilterRules of a PMC configuration.
+
+    Like in Procmon, an event is dropped if any of the exclude rules matches it. If there are include rules, the event
+    must match at least one include rule of every column that has include rules.
+    The rules on the process of the event are checked once per process, then the rules on the fixed fields of the
+    event, then the rules on the operation, and the rules that need the details of the event are checked last.
+    """
+
+    def __init__(self, rules, first_event_date_filetime=None):
+        """
+        :param rules: a list of ``Rule`` objects.
+        :param first_event_date_filetime: the date of the first event in the log, for rules on the relative time.
+        """
+        self.rules = list(rules)
+        self._first_event_date_filetime = first_event_date_filetime
+        rules_by_column = {}
+        for rule in self.rules:
+            if rule.column not in COMPATIBLE_CSV_COLUMN_GETTERS:
+                raise ValueError("Can't filter events by the column {}".format(rule.column.name))
+            rules_by_column.setdefault(rule.column, []).append(rule)
+
+        def column_checks(columns):
+            checks = []
+            for column in columns:
+                exclude_rules = [r for r in rules_by_column.get(column, []) if r.action == RuleAction.EXCLUDE]
+                include_rules = [r for r in rules_by_column.get(column, []) if r.action == RuleAction.INCLUDE]
+                if exclude_rules or include_rules:
+                    checks.append((COMPATIBLE_CSV_COLUMN_GETTERS[column],
+                                   _column_matcher(exclude_rules) if exclude_rules else None,
+                                   _column_matcher(include_rules) if include_rules else None))
+            return checks
+
+        event_columns = [c for c in rules_by_column
+                         if c not in PROCESS_COLUMNS and c not in DETAIL_COLUMNS and c != Column.OPERATION]
+        self._process_checks = column_checks(PROCESS_COLUMNS)
+        self._checks = column_checks(event_columns)
+        operation_checks = column_checks([Column.OPERATION])
+        self._operation_check = operation_checks[0] if operation_checks else None
+        self._detail_checks = column_checks(DETAIL_COLUMNS)
+        self._process_results = {}
+        self._operation_names_results = {}
+
+    @staticmethod
+    def _check_value(value, exclude, include):
+        if exclude is not None and exclude(value):
+            return False
+        return include is None or include(value)
+
+    def _check(self, checks, event):
+        for get_value, exclude, include in checks:
+            value = get_value(event, self._first_event_date_filetime or event.date_filetime)
+            if not self._check_value(value, exclude, include):
+                return False
+        return True
+
+    def _check_operation(self, event):
+        """Check the rules on the operation. If the operation of a lazy event is not loaded yet, and the rules give
+        the same result for all the names that it can have, the details of the event are not loaded.
+        """
+        get_value, exclude, include = self._operation_check
+        operation_names = getattr(event, "_operation_names", None)
+        if operation_names is not None and "operation" not in event.__dict__:
+            key = (event.event_class, operation_names)
+            result = self._operation_names_results.get(key)
+            if result is None:
+                results = set(self._check_value(get_compatible_csv_operation_name(event.event_class, name), exclude,
+                                                include) for name in operation_names)
+                # When the names give different results, the result depends on the details
+                result = results.pop() if len(results) == 1 else _UNDECIDED
+                self._operation_names_results[key] = result
+            if result is not _UNDECIDED:
+                return result
+        return self._check_value(get_value(event, self._first_event_date_filetime or event.date_filetime), exclude,
+                                 include)
+
+    def __call__(self, event):
+        """Returns True if the event passes the rules.
+        """
+        if self._process_checks:
+            # The processes are shared by all the events of a log, so the result is kept by the identity of the process
+            process_result = self._process_results.get(id(event.process))
+            if process_result is None:
+                process_result = self._process_results[id(event.process)] = self._check(self._process_checks, event)
+            if not process_result:
+                return False
+        if not self._check(self._checks, event):
+            return False
+        if self._operation_check is not None and not self._check_operation(event):
+            return False
+        return self._check(self._detail_checks, event)
+
+
+def compile_rules(rules, first_event_date_filetime=None):
+    """Compile a list of ``Rule`` objects into a predicate over events, see ``RulesFilter``.
+    Returns None if there are no rules.
+    """
+    if not rules:
+        return None
+    return RulesFilter(rules, first_event_date_filetime)
@@ -0,0 +1,219 @@
+"""
+A sidecar index of a PML file (a ".pmlidx" file next to it), with the offsets and the fixed fields of the events and
+the process table, so the file can be reopened and queried by the fixed fields of its events without scanning it again
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from struct import Struct
+
+# The arrays of the index are memory mapped numpy arrays, so the whole index requires numpy, which is an optional
+# dependency of the package
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from procmon_parser.logs import Process, PMLError
+from procmon_parser.stream_logs_format import Header, EventOffsetsArray, PMLStreamReader, get_pid_column
+
+__all__ = ['INDEX_EXTENSION', 'INDEX_VERSION', 'INDEX_COLUMNS', 'PMLIndex', 'get_index_path', 'build_index',
+           'load_index']
+
+
+INDEX_EXTENSION = ".pmlidx"
+INDEX_VERSION = 1
+INDEX_MAGIC = b"PMLIDX\x00\x00"
+
+# The magic, the version and the size of the JSON description of the index. The description is followed by the
+# arrays, which are aligned, and their offsets in the description are from the (aligned) end of the description.
+IndexPrefixStruct = Struct("<8sII")
+INDEX_ALIGNMENT = 8
+
+# The fixed fields of the events that are kept in the index
+INDEX_COLUMNS = ("process_index", "tid", "event_class", "operation", "duration", "date_filetime", "result")
+
+# The fields of the processes that are kept in the index, which doesn't have their modules
+INDEX_PROCESS_FIELDS = ("pid", "parent_pid", "authentication_id", "session", "virtualized", "is_process_64bit",
+                        "integrity", "user", "process_name", "image_path", "command_line", "company", "version",
+                        "description", "start_time", "end_time")
+
+
+def get_index_path(pml_path):
+    """Get the path of the sidecar index of a PML file, like "Log.pmlidx" for "Log.PML".
+    """
+    return os.path.splitext(pml_path)[0] + INDEX_EXTENSION
+
+
+def _pml_signature(pml_path):
+    """Get what the index of a PML file is validated against: the size and the modification time of the file, and a
+    hash of its header.
+    """
+    stat = os.stat(pml_path)
+    with open(pml_path, "rb") as f:
+        header_hash = hashlib.sha1(f.read(Header.SIZE)).hexdigest()
+    return {"pml_size": stat.st_size, "pml_mtime": stat.st_mtime, "pml_header_sha1": header_hash}
+
+
+def _align(offset):
+    return offset + -offset % INDEX_ALIGNMENT
+
+
+class PMLIndex(object):
+    """The sidecar index of a PML file. The arrays of the index are memory mapped from the index file, so opening it
+    doesn't read them.
+    """
+
+    def __init__(self, path):
+        """Open an index file. Use ``load_index`` to open the index of a PML file only if it is up to date.
+
+        :param path: the path of the index file.
+        """
+        if numpy is None:
+            raise ImportError("The PML index requires numpy")
+        self.path = path
+        with open(path, "rb") as f:
+            prefix = f.read(IndexPrefixStruct.size)
+            if len(prefix) != IndexPrefixStruct.size or prefix[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise PMLError("not a PML index file.")
+            _, version, description_size = IndexPrefixStruct.unpack(prefix)
+            if version != INDEX_VERSION:
+                raise PMLError("Not supporting PML index version {}".format(version))
+            try:
+                self._description = json.loads(f.read(description_size).decode("utf-8"))
+            except ValueError:
+                raise PMLError("The PML index is truncated")
+        try:
+            self._load(path, _align(IndexPrefixStruct.size + description_size))
+        except (KeyError, TypeError, ValueError):
+            raise PMLError("The PML index is corrupt")
+
+    def _load(self, path, data_start):
+        if os.path.getsize(path) != data_start + self._description["data_size"]:
+            raise PMLError("The PML index is truncated")
+
+        data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+        arrays = {}
+        for name, dtype, offset, count in self._description["arrays"]:
+            dtype = numpy.dtype(str(dtype))
+            offset += data_start
+            arrays[name] = data[offset:offset + count * dtype.itemsize].view(dtype)
+        self._number_of_events = self._description["number_of_events"]
+        self.events_offsets = EventOffsetsArray(arrays["offsets"], arrays["flags"])
+        self.columns = OrderedDict((name, arrays[name]) for name in INDEX_COLUMNS)
+        self.processes = OrderedDict((process_index, Process(**fields))
+                                     for process_index, fields in self._description["processes"])
+
+    @property
+    def number_of_events(self):
+        return self._number_of_events
+
+    def is_valid(self, pml_path):
+        """Check that the PML file didn't change since the index was built.
+        """
+        signature = _pml_signature(pml_path)
+        return all(self._description.get(key) == value for key, value in signature.items())
+
+    def scan_columns(self, columns=None):
+        """Get the fixed fields of all the events from the index, like ``PMLStreamReader.scan_columns``.
+
+        :param columns: names of the columns to get, the names in ``INDEX_COLUMNS`` or "pid". Default is all.
+        :return: an ordered dictionary of column name to a read-only numpy array with a value for every event.
+        """
+        available_columns = list(INDEX_COLUMNS) + ["pid"]
+        columns = available_columns if columns is None else list(columns)
+        result = OrderedDict()
+        for column in columns:
+            if column == "pid":
+                result[column] = get_pid_column(self.processes, self.columns["process_index"])
+            elif column in self.columns:
+                result[column] = self.columns[column]
+            else:
+                raise ValueError("Unknown column \"{}\", expected one of {}".format(
+                    column, ", ".join(available_columns)))
+        return result
+
+
+def build_index(pml_path, index_path=None):
+    """Scan a PML file and write its sidecar index.
+
+    :param pml_path: the path of the PML file.
+    :param index_path: the path of the index file, by default the one from ``get_index_path``.
+    :return: the ``PMLIndex`` of the file.
+    """
+    if numpy is None:
+        raise ImportError("The PML index requires numpy")
+    index_path = index_path or get_index_path(pml_path)
+    signature = _pml_signature(pml_path)
+    with open(pml_path, "rb") as f:
+        reader = PMLStreamReader(f, should_get_stacktrace=False, should_get_details=False)
+        arrays = OrderedDict([("offsets", numpy.asarray(reader.events_offsets.offsets, dtype="<u4")),
+                              ("flags", numpy.asarray(reader.events_offsets.flags, dtype="u1"))])
+        arrays.update(reader.scan_columns(INDEX_COLUMNS))
+        processes = [[process_index, OrderedDict((field, getattr(process, field)) for field in INDEX_PROCESS_FIELDS)]
+                     for process_index, process in reader.process_table.items()]
+        number_of_events = reader.number_of_events
+
+    arrays_layout = []
+    data_size = 0
+    for name, array in arrays.items():
+        data_size = _align(data_size)
+        arrays_layout.append((name, array.dtype.str, data_size, len(array)))
+        data_size += array.nbytes
+    description = OrderedDict([("number_of_events", number_of_events), ("data_size", data_size),
+                               ("arrays", arrays_layout), ("processes", processes)])
+    description.update(signature)
+    encoded_description = json.dumps(description).encode("utf-8")
+
+    # The index is written to a temporary file that replaces the index file only when it is complete, so an
+    # interrupted build doesn't leave a truncated index
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(index_path) + ".",
+                                     dir=os.path.dirname(os.path.abspath(index_path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(IndexPrefixStruct.pack(INDEX_MAGIC, INDEX_VERSION, len(encoded_description)))
+            f.write(encoded_description)
+            data_start = _align(IndexPrefixStruct.size + len(encoded_description))
+            for (_, _, offset, _), array in zip(arrays_layout, arrays.values()):
+                f.write(b"\x00" * (data_start + offset - f.tell()))
+                f.write(array.tobytes())
+        # The temporary file is created readable only by its owner, the index is readable like the PML file
+        os.chmod(temp_path, os.stat(pml_path).st_mode & 0o777)
+        _replace(temp_path, index_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return PMLIndex(index_path)
+
+
+def _replace(source, destination):
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    else:  # Python 2, where rename doesn't replace an existing file on Windows
+        if os.name == "nt" and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def load_index(pml_path, index_path=None, build=True):
+    """Open the sidecar index of a PML file, and build it again if it is missing or out of date.
+
+    :param pml_path: the path of the PML file.
+    :param index_path: the path of the index file, by default the one from ``get_index_path``.
+    :param build: False to return None instead of building the index.
+    :return: the ``PMLIndex`` of the file, or None.
+    """
+    if numpy is None:
+        raise ImportError("The PML index requires numpy")
+    index_path = index_path or get_index_path(pml_path)
+    if os.path.exists(index_path):
+        try:
+            index = PMLIndex(index_path)
+        except PMLError:
+            index = None  # an index of another version, or that was not completely written
+        if index is not None and index.is_valid(pml_path):
+            return index
+    return build_index(pml_path, index_path) if build else None
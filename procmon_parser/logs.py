@@ -3,14 +3,21 @@ Python types that procmon logs use
 """
 
 import binascii
+import bisect
 import datetime
 import enum
+import ntpath
+import sys
+from collections import OrderedDict
+import struct
+import threading
 
 from six import string_types
 
 from procmon_parser.consts import Column, EventClass, get_error_message, ProcessOperation, ColumnToOriginalName
 
-__all__ = ['PMLError', 'Module', 'Process', 'Event', 'PMLStructReader']
+__all__ = ['PMLError', 'Module', 'Process', 'LazyProcess', 'Event', 'CompactEvent', 'LazyEvent', 'StacktraceTable',
+           'PMLStructReader']
 
 
 EPOCH_AS_FILETIME = 116444736000000000  # January 1, 1970 as MS file time
@@ -21,6 +28,16 @@ class PMLError(RuntimeError):
     pass
 
 
+def datetime_to_filetime(d):
+    """Convert a datetime in UTC to a FILETIME value, the opposite of ``Event.date()``.
+    """
+    if d.tzinfo is not None:
+        d = d.replace(tzinfo=None) - d.utcoffset()
+    delta = d - datetime.datetime(1970, 1, 1)
+    return EPOCH_AS_FILETIME + (delta.days * 86400 + delta.seconds) * HUNDREDS_OF_NANOSECONDS + \
+        delta.microseconds * 10
+
+
 class Module(object):
     """Information about a loaded module in a process or in the kernel
     """
@@ -55,6 +72,24 @@ class Module(object):
         return hash((self.base_address, self.size, self.path, self.timestamp))
 
 
+class _LazyAttribute(object):
+    """An attribute of a lazy object (like a lazy event) which is loaded on the first access.
+
+    This is a non-data descriptor, so after the loader stores the value in the instance dictionary the descriptor is
+    not used anymore and the next accesses are as fast as a regular attribute.
+    """
+
+    def __init__(self, name, loader_name):
+        self._name = name
+        self._loader_name = loader_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        getattr(instance, self._loader_name)()
+        return instance.__dict__[self._name]
+
+
 class Process(object):
     """Information about a process in the system
     """
@@ -80,11 +115,66 @@ class Process(object):
         self.end_time = end_time
         self.modules = modules or []
 
+    def _public_dict(self):
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
     def __eq__(self, other):
-        if type(other) is type(self):
-            return self.__dict__ == other.__dict__
+        if isinstance(other, Process):
+            return self._public_dict() == other._public_dict()
         return False
 
+    def __getstate__(self):
+        return self._public_dict()
+
+    def _count_modules(self):
+        return len(self.modules)
+
+    def _get_module_index(self):
+        """Get the modules sorted by their base address, with their base addresses and a cache of the symbolized
+        addresses. It is built on the first use, and again if the modules are replaced.
+        """
+        module_index = self.__dict__.get("_module_index")
+        if module_index is None or module_index[0] is not self.modules:
+            modules = sorted(self.modules, key=lambda m: m.base_address)
+            module_index = self._module_index = (self.modules, [m.base_address for m in modules], modules, {})
+        return module_index
+
+    def module_for_address(self, address):
+        """Get the loaded module of the process that contains an address, or None if there isn't one.
+        """
+        _, base_addresses, modules, _ = self._get_module_index()
+        i = bisect.bisect_right(base_addresses, address) - 1
+        if i >= 0 and address < modules[i].base_address + modules[i].size:
+            return modules[i]
+        return None
+
+    def _symbolize_address(self, address):
+        symbols = self._get_module_index()[3]
+        try:
+            return symbols[address]
+        except KeyError:
+            module = self.module_for_address(address)
+            symbol = symbols[address] = None if module is None else "{}+0x{:x}".format(
+                ntpath.basename(module.path), address - module.base_address)
+            return symbol
+
+    def symbolize(self, stacktrace, fallback=None):
+        """Get the frames of a stack trace of the process as "module.dll+0x1234" strings. The results are cached per
+        address, so symbolizing the same frames again is a dictionary lookup.
+
+        :param stacktrace: the addresses of the frames, like ``Event.stacktrace``.
+        :param fallback: a process whose modules are used for the addresses that are not in a module of this process,
+        like the System process which has the kernel modules.
+        :return: a list with a string for every frame, or the hexadecimal address if it is not in a known module.
+        """
+        symbolized_frames = []
+        for address in stacktrace:
+            symbol = self._symbolize_address(address)
+            if symbol is None and fallback is not None:
+                symbol = fallback._symbolize_address(address)
+            symbolized_frames.append("0x{:x}".format(address) if symbol is None else symbol)
+        return symbolized_frames
+
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -101,12 +191,63 @@ class Process(object):
         return hash((self.pid, self.parent_pid, self.image_path, self.command_line, self.start_time, self.end_time))
 
 
-class Event(object):
+class LazyProcess(Process):
+    """A process that reads its modules from the PML file only when they are accessed for the first time.
+    """
+
+    modules = _LazyAttribute("modules", "_load_modules")
+
+    def __init__(self, modules_loader, number_of_modules=0, **kwargs):
+        """
+        :param modules_loader: a function that reads the list of the modules of the process.
+        :param number_of_modules: the number of modules of the process, which is known without reading them.
+        """
+        super(LazyProcess, self).__init__(**kwargs)
+        del self.modules  # loaded on the first access
+        self._modules_loader = modules_loader
+        self._number_of_modules = number_of_modules
+
+    def _load_modules(self):
+        self.modules = self._modules_loader()
+
+    def _count_modules(self):
+        if "modules" in self.__dict__:
+            return len(self.modules)
+        return self._number_of_modules
+
+    def load(self):
+        """Load the modules of the process.
+        """
+        getattr(self, "modules")
+        return self
+
+    def _public_dict(self):
+        self.load()
+        return super(LazyProcess, self)._public_dict()
+
+
+def get_compatible_csv_operation_name(event_class, operation):
+    """Get the name of an operation like in the CSV that Procmon exports.
+    """
+    if "<Unknown>" in operation:
+        return "<Unknown>"
+    if EventClass.Process == event_class:
+        return operation.replace('_', ' ')
+    return operation
+
+
+class _EventBase(object):
+    """The fields and the methods of an event, which are shared by the event types.
+    """
+    __slots__ = ()
+
     def __init__(self, process=None, tid=0, event_class=None, operation=None, duration=0,
                  date_filetime=None, result=0, stacktrace=None, category=None, path=None, details=None):
         self.process = process
         self.tid = tid
-        self.event_class = EventClass[event_class] if isinstance(event_class, string_types) else EventClass(event_class)
+        if type(event_class) is not EventClass:
+            event_class = EventClass[event_class] if isinstance(event_class, string_types) else EventClass(event_class)
+        self.event_class = event_class
         self.operation = operation.name if isinstance(operation, enum.IntEnum) else operation
         self.date_filetime = date_filetime
         self.result = result
@@ -116,11 +257,6 @@ class Event(object):
         self.path = path
         self.details = details
 
-    def __eq__(self, other):
-        if type(other) is type(self):
-            return self.__dict__ == other.__dict__
-        return False
-
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -146,20 +282,29 @@ class Event(object):
         else:
             return None
 
+    # The formatted parts of the last formatted second, which is almost always the second of the next event too
+    _strftime_last_second = (None, None, None, None)
+
     @staticmethod
     def _strftime_date(date_filetime, show_day=True, show_nanoseconds=False):
         # Actually Procmon prints it in local time instead of UTC
         hundred_nanoseconds = (date_filetime % HUNDREDS_OF_NANOSECONDS)
-        d = datetime.datetime.utcfromtimestamp((date_filetime - EPOCH_AS_FILETIME) // HUNDREDS_OF_NANOSECONDS)
+        seconds = (date_filetime - EPOCH_AS_FILETIME) // HUNDREDS_OF_NANOSECONDS
+        last_seconds, day, hours_minutes_seconds, am_pm = _EventBase._strftime_last_second
+        if seconds != last_seconds:
+            d = datetime.datetime.utcfromtimestamp(seconds)
+            day = d.strftime("%m/%d/%Y ").lstrip('0').replace('/0', '/')
+            hours_minutes_seconds = d.strftime("%I:%M:%S").lstrip('0')
+            am_pm = d.strftime("%p")
+            _EventBase._strftime_last_second = (seconds, day, hours_minutes_seconds, am_pm)
 
         if show_nanoseconds:
-            time_of_day = d.strftime("%I:%M:%S.{:07d} %p").lstrip('0').format(hundred_nanoseconds)
+            time_of_day = "{}.{:07d} {}".format(hours_minutes_seconds, hundred_nanoseconds, am_pm)
         else:
-            time_of_day = d.strftime("%I:%M:%S %p").lstrip('0')
+            time_of_day = "{} {}".format(hours_minutes_seconds, am_pm)
 
         if not show_day:
             return time_of_day
-        day = d.strftime("%m/%d/%Y ").lstrip('0').replace('/0', '/')
         return day + time_of_day
 
     @staticmethod
@@ -185,11 +330,7 @@ class Event(object):
         return "n/a"
 
     def _get_compatible_csv_operation_name(self):
-        if "<Unknown>" in self.operation:
-            return "<Unknown>"
-        if EventClass.Process == self.event_class:
-            return self.operation.replace('_', ' ')
-        return self.operation
+        return get_compatible_csv_operation_name(self.event_class, self.operation)
 
     def _get_compatible_csv_detail_column(self):
         """Returns the detail column as a string which is compatible to Procmon's detail format in the exported csv.
@@ -250,49 +391,212 @@ class Event(object):
 
         return ", ".join("{}: {}".format(k, v) for k, v in details.items())
 
+    def get_compatible_csv_column(self, column, first_event_date_filetime=None):
+        """Returns the data of a single Procmon column in compatible format to the exported csv by procmon
+        """
+        first_event_date_filetime = first_event_date_filetime if first_event_date_filetime else self.date_filetime
+        return COMPATIBLE_CSV_COLUMN_GETTERS[column](self, first_event_date_filetime)
+
     def get_compatible_csv_info(self, first_event_date_filetime=None):
         """Returns data for every Procmon column in compatible format to the exported csv by procmon
         """
         first_event_date_filetime = first_event_date_filetime if first_event_date_filetime else self.date_filetime
-        record = {
-            Column.DATE_AND_TIME: Event._strftime_date(self.date_filetime, True, False),
-            Column.PROCESS_NAME: self.process.process_name,
-            Column.PID: str(self.process.pid),
-            Column.OPERATION: self._get_compatible_csv_operation_name(),
-            Column.RESULT: get_error_message(self.result),
-            Column.DETAIL: self._get_compatible_csv_detail_column(),
-            Column.SEQUENCE: 'n/a',  # They do it too
-            Column.COMPANY: self.process.company,
-            Column.DESCRIPTION: self.process.description,
-            Column.COMMAND_LINE: self.process.command_line,
-            Column.USER: self.process.user,
-            Column.IMAGE_PATH: self.process.image_path,
-            Column.SESSION: str(self.process.session),
-            Column.PATH: self.path,
-            Column.TID: str(self.tid),
-            Column.RELATIVE_TIME: Event._strftime_relative_time(self.date_filetime - first_event_date_filetime),
-            Column.DURATION:
-                Event._strftime_duration(self.duration) if get_error_message(self.result) != "" else "",
-            Column.TIME_OF_DAY: Event._strftime_date(self.date_filetime, False, True),
-            Column.VERSION: self.process.version,
-            Column.EVENT_CLASS: self.event_class.name.replace('_', ' '),
-            Column.AUTHENTICATION_ID:
-                "{:08x}:{:08x}".format(self.process.authentication_id >> 32,
-                                       self.process.authentication_id & 0xFFFFFFFF),
-            Column.VIRTUALIZED: Event._get_bool_str(self.process.virtualized),
-            Column.INTEGRITY: self.process.integrity,
-            Column.CATEGORY: self.category,
-            Column.PARENT_PID: str(self.process.parent_pid),
-            Column.ARCHITECTURE: "64-bit" if self.process.is_process_64bit else "32-bit",
-            Column.COMPLETION_TIME:
-                Event._strftime_date(self.date_filetime + self.duration, False, True)
-                if get_error_message(self.result) != "" else "",
-        }
-
-        compatible_record = {ColumnToOriginalName[k]: v for k, v in record.items()}
+        compatible_record = {ColumnToOriginalName[k]: getter(self, first_event_date_filetime)
+                             for k, getter in COMPATIBLE_CSV_COLUMN_GETTERS.items()}
         return compatible_record
 
 
+# Functions of an event and the date of the first event, that return the data of a column like in the exported csv
+COMPATIBLE_CSV_COLUMN_GETTERS = {
+    Column.DATE_AND_TIME: lambda e, first: Event._strftime_date(e.date_filetime, True, False),
+    Column.PROCESS_NAME: lambda e, first: e.process.process_name,
+    Column.PID: lambda e, first: str(e.process.pid),
+    Column.OPERATION: lambda e, first: e._get_compatible_csv_operation_name(),
+    Column.RESULT: lambda e, first: get_error_message(e.result),
+    Column.DETAIL: lambda e, first: e._get_compatible_csv_detail_column(),
+    Column.SEQUENCE: lambda e, first: 'n/a',  # They do it too
+    Column.COMPANY: lambda e, first: e.process.company,
+    Column.DESCRIPTION: lambda e, first: e.process.description,
+    Column.COMMAND_LINE: lambda e, first: e.process.command_line,
+    Column.USER: lambda e, first: e.process.user,
+    Column.IMAGE_PATH: lambda e, first: e.process.image_path,
+    Column.SESSION: lambda e, first: str(e.process.session),
+    Column.PATH: lambda e, first: e.path,
+    Column.TID: lambda e, first: str(e.tid),
+    Column.RELATIVE_TIME: lambda e, first: Event._strftime_relative_time(e.date_filetime - first),
+    Column.DURATION: lambda e, first:
+        Event._strftime_duration(e.duration) if get_error_message(e.result) != "" else "",
+    Column.TIME_OF_DAY: lambda e, first: Event._strftime_date(e.date_filetime, False, True),
+    Column.VERSION: lambda e, first: e.process.version,
+    Column.EVENT_CLASS: lambda e, first: e.event_class.name.replace('_', ' '),
+    Column.AUTHENTICATION_ID: lambda e, first:
+        "{:08x}:{:08x}".format(e.process.authentication_id >> 32, e.process.authentication_id & 0xFFFFFFFF),
+    Column.VIRTUALIZED: lambda e, first: Event._get_bool_str(e.process.virtualized),
+    Column.INTEGRITY: lambda e, first: e.process.integrity,
+    Column.CATEGORY: lambda e, first: e.category,
+    Column.PARENT_PID: lambda e, first: str(e.process.parent_pid),
+    Column.ARCHITECTURE: lambda e, first: "64-bit" if e.process.is_process_64bit else "32-bit",
+    Column.COMPLETION_TIME: lambda e, first:
+        Event._strftime_date(e.date_filetime + e.duration, False, True) if get_error_message(e.result) != "" else "",
+}
+
+
+class Event(_EventBase):
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__dict__ == other.__dict__
+        elif type(other) is CompactEvent:
+            return other == self
+        return False
+
+    __hash__ = _EventBase.__hash__
+
+
+# The details of compact events are plain dictionaries where they keep the order of insertion
+CompactEventDetails = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
+class CompactEvent(_EventBase):
+    """An event without an instance dictionary, which takes a lot less memory when many events are kept.
+    The details of a compact event are a plain dictionary.
+    """
+    __slots__ = ('process', 'tid', 'event_class', 'operation', 'date_filetime', 'result', 'duration', 'stacktrace',
+                 'category', 'path', 'details')
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is CompactEvent:
+            return self._values() == other._values()
+        elif type(other) is Event:
+            return dict(zip(self.__slots__, self._values())) == other.__dict__
+        return False
+
+    def __hash__(self):
+        return super(CompactEvent, self).__hash__()
+
+    def __getstate__(self):
+        return self._values()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class LazyEvent(Event):
+    """An event that decodes its path, category, details and stack trace only when they are accessed for the first
+    time. The operation is also lazy when the details can refine it (like the protocol of network events).
+    """
+
+    path = _LazyAttribute("path", "_load_details")
+    category = _LazyAttribute("category", "_load_details")
+    details = _LazyAttribute("details", "_load_details")
+    operation = _LazyAttribute("operation", "_load_details")
+    stacktrace = _LazyAttribute("stacktrace", "_load_stacktrace")
+
+    # The names that a lazy operation can have after it is loaded
+    _operation_names = None
+
+    def __init__(self, offset, loader, process=None, tid=0, event_class=None, operation=None, duration=0,
+                 date_filetime=None, result=0, operation_names=None):
+        """
+        :param offset: the offset of the event in the PML file.
+        :param loader: a function that gets the event and whether to load the details or the stack trace, and sets
+        the lazy attributes of the event.
+        :param operation_names: if the operation is lazy, all the names that it can have, so filters can be checked
+        without loading the details when all of these names give the same result.
+        """
+        self._offset = offset
+        self._loader = loader
+        if operation_names is not None:
+            self._operation_names = operation_names
+        self.process = process
+        self.tid = tid
+        self.event_class = event_class
+        if operation is not None:
+            self.operation = operation
+        self.date_filetime = date_filetime
+        self.result = result
+        self.duration = duration
+
+    def _load_details(self):
+        self._loader(self, True)
+
+    def _load_stacktrace(self):
+        self._loader(self, False)
+
+    def load(self):
+        """Load all the lazy attributes of the event.
+        """
+        for name in ("details", "stacktrace"):
+            getattr(self, name)
+        return self
+
+    def _public_dict(self):
+        self.load()
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+    def __eq__(self, other):
+        if isinstance(other, LazyEvent):
+            return self._public_dict() == other._public_dict()
+        elif type(other) is Event:
+            return self._public_dict() == other.__dict__
+        return False
+
+    def __hash__(self):
+        return super(LazyEvent, self).__hash__()
+
+    def __getstate__(self):
+        return self._public_dict()
+
+
+class StacktraceTable(object):
+    """A table of the distinct stack traces of a log. Identical stack traces (like the stack traces of a hot loop) are
+    decoded once and share one immutable tuple, which has an ID in the table that can be used in aggregations.
+    New stack traces are added under a lock, so the table can be shared by threads that read events.
+    """
+
+    def __init__(self, sizeof_pvoid):
+        self._pvoid_format = "Q" if sizeof_pvoid == 8 else "I"
+        self._sizeof_pvoid = sizeof_pvoid
+        self._ids = {}  # the raw stack trace to its ID
+        self._stacktrace_ids = {}  # the stack trace to its ID
+        self._stacktraces = []
+        self._lock = threading.Lock()
+
+    def intern(self, raw_stacktrace):
+        """Get the shared stack trace of a raw stack trace, and add it to the table if it is new.
+        """
+        raw_stacktrace = bytes(raw_stacktrace)
+        stacktrace_id = self._ids.get(raw_stacktrace)
+        if stacktrace_id is None:
+            stacktrace = struct.unpack("<{}{}".format(len(raw_stacktrace) // self._sizeof_pvoid, self._pvoid_format),
+                                       raw_stacktrace)
+            with self._lock:
+                # Another thread could have added the stack trace since it was looked up
+                stacktrace_id = self._ids.get(raw_stacktrace)
+                if stacktrace_id is None:
+                    self._stacktraces.append(stacktrace)
+                    stacktrace_id = self._stacktrace_ids[stacktrace] = len(self._stacktraces) - 1
+                    self._ids[raw_stacktrace] = stacktrace_id
+        return self._stacktraces[stacktrace_id]
+
+    def get_id(self, stacktrace):
+        """Get the ID of a stack trace in the table.
+        """
+        return self._stacktrace_ids[tuple(stacktrace)]
+
+    def __getitem__(self, stacktrace_id):
+        return self._stacktraces[stacktrace_id]
+
+    def __len__(self):
+        return len(self._stacktraces)
+
+    def __iter__(self):
+        return iter(self._stacktraces)
+
+
 class PMLStructReader(object):
     @property
     def header(self):
@@ -0,0 +1,103 @@
+"""
+Parsing the events of a PML file in multiple processes
+"""
+
+import functools
+import multiprocessing
+import multiprocessing.util
+from collections import namedtuple
+
+from procmon_parser.stream_logs_format import PMLStreamReader
+
+__all__ = ['EventSummary', 'summarize_event', 'parallel_read_events']
+
+
+EventSummary = namedtuple('EventSummary', ['pid', 'process_name', 'tid', 'event_class', 'operation', 'date_filetime',
+                                           'duration', 'result', 'path'])
+
+
+def summarize_event(event):
+    """Returns a compact and picklable summary of an event, which is cheap to send between processes.
+    """
+    return EventSummary(event.process.pid, event.process.process_name, event.tid, int(event.event_class),
+                        event.operation, event.date_filetime, event.duration, event.result, event.path)
+
+
+# The state of a worker process, which is built once by the pool initializer and used for all of its chunks.
+_worker_file = None
+_worker_reader = None
+_worker_map_fn = None
+_worker_reduce_fn = None
+
+# The result of a chunk without events, because None can be a result of the reduce function
+_NO_RESULT = object()
+
+
+def _init_worker(path, reader_kwargs, map_fn, reduce_fn):
+    global _worker_file, _worker_reader, _worker_map_fn, _worker_reduce_fn
+    _worker_file = open(path, "rb")
+    # The file is closed when the worker exits, after the pool is closed
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=0)
+    _worker_reader = PMLStreamReader(_worker_file, **reader_kwargs)
+    _worker_map_fn = map_fn
+    _worker_reduce_fn = reduce_fn
+
+
+def _close_worker():
+    global _worker_file, _worker_reader
+    try:
+        if _worker_reader is not None:
+            _worker_reader.close()
+    finally:
+        _worker_file.close()
+        _worker_file = _worker_reader = None
+
+
+def _read_events_range(events_range):
+    start, stop = events_range
+    results = _worker_reader.iter_events(start, stop)
+    if _worker_map_fn is not None:
+        results = (_worker_map_fn(result) for result in results)
+    if _worker_reduce_fn is not None:
+        first_result = next(results, _NO_RESULT)
+        if first_result is _NO_RESULT:
+            return []  # no event of the chunk matches the filter of the reader
+        return [functools.reduce(_worker_reduce_fn, results, first_result)]
+    return list(results)
+
+
+def parallel_read_events(path, number_of_events, reader_kwargs=None, workers=None, chunk_size=10000, map_fn=None,
+                         reduce_fn=None):
+    """Reads the events of a PML file in a pool of worker processes, and yields the results in the original order of
+    the events.
+
+    Every worker opens the file and builds its tables once, and then parses ranges of ``chunk_size`` events.
+    ``map_fn`` and ``reduce_fn`` run inside the workers, so only their results are sent back. They must be picklable
+    (module level functions) when the processes are not forked.
+
+    :param path: the path to the PML file.
+    :param number_of_events: the number of events in the file.
+    :param reader_kwargs: keyword arguments for the ``PMLStreamReader`` of every worker.
+    :param workers: number of worker processes, the number of CPUs by default.
+    :param chunk_size: number of events in every task of a worker.
+    :param map_fn: a function that is applied to every event in the worker, like ``summarize_event``.
+    :param reduce_fn: a function of two (mapped) values that returns a value of the same kind. If given, every chunk
+    is reduced in its worker and only one partial result per chunk is yielded.
+    """
+    events_ranges = [(start, min(start + chunk_size, number_of_events))
+                     for start in range(0, number_of_events, chunk_size)]
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(path, reader_kwargs or {}, map_fn, reduce_fn))
+    completed = False
+    try:
+        for results in pool.imap(_read_events_range, events_ranges):
+            for result in results:
+                yield result
+        completed = True
+    finally:
+        # Let the workers exit (and close their files) unless the results are not needed anymore
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
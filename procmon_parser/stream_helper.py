@@ -1,4 +1,7 @@
+import os
 import struct
+import sys
+from array import array
 
 unpacker_u8 = struct.Struct('B').unpack
 unpacker_u16 = struct.Struct('<H').unpack
@@ -7,6 +10,97 @@ unpacker_u64 = struct.Struct('<Q').unpack
 unpacker_s64 = struct.Struct('<q').unpack
 
 
+def _get_array_typecodes():
+    """Get the unsigned array typecode of every item size. Python 2 has no "Q" typecode, so "L" is used for 8 bytes
+    where it is 8 bytes long.
+    """
+    typecodes = {}
+    for typecode in "QLI":
+        try:
+            typecodes.setdefault(array(typecode).itemsize, typecode)
+        except ValueError:
+            pass
+    return typecodes
+
+
+ARRAY_TYPECODES = _get_array_typecodes()
+
+
+class BufferStream(object):
+    """A read only stream over a buffer (like a memory mapped file) which returns ``memoryview`` slices of the buffer
+    instead of copying the data.
+    """
+    __slots__ = ("_view", "_size", "_position")
+
+    def __init__(self, buffer, position=0):
+        self._view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+        self._size = len(self._view)
+        self._position = position
+
+    def read(self, size=-1):
+        start = self._position
+        end = self._size if size is None or size < 0 else min(start + size, self._size)
+        self._position = max(start, end)
+        return self._view[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek value {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def getvalue(self):
+        return self._view
+
+
+class PositionalStream(object):
+    """A read only stream over a file descriptor, which reads with ``os.pread`` from a position of its own.
+    Unlike a file object it doesn't move the position of the file, so threads can read the same file at the same time
+    when each of them uses its own stream.
+    """
+    __slots__ = ("_fd", "_position", "_block", "_block_start")
+
+    BLOCK_SIZE = 0x1000  # read ahead, so the small reads of a structure don't cost a system call each
+
+    def __init__(self, fd, position=0):
+        self._fd = fd
+        self._position = position
+        self._block = b""
+        self._block_start = position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, os.fstat(self._fd).st_size - self._position)
+        start = self._position - self._block_start
+        if start < 0 or start + size > len(self._block):
+            self._block = os.pread(self._fd, max(size, self.BLOCK_SIZE), self._position)
+            self._block_start = self._position
+            start = 0
+        data = self._block[start:start + size]
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += os.fstat(self._fd).st_size
+        if offset < 0:
+            raise ValueError("negative seek value {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
 def read_u8(io):
     return unpacker_u8(io.read(1))[0]
 
@@ -35,45 +129,149 @@ def get_pvoid_reader(is_64bit):
     return read_u64 if is_64bit else read_u32
 
 
-def read_utf16(io, size=-1):
-    raw = b""
-    i = 0
-    while size == -1 or i < size:
-        wchar = io.read(2)
-        i += 2
-        if wchar == b"" or wchar == b"\x00\x00":
-            break
-        raw += wchar
-    if i < size:
-        io.seek(size - i, 1)
+def read_pvoid_array(data, sizeof_pvoid):
+    """Decode an array of pointers with a single call, to an ``array`` of unsigned integers (or to a list where there
+    is no array type of that size).
+    """
+    typecode = ARRAY_TYPECODES.get(sizeof_pvoid)
+    if typecode is None:
+        return list(struct.unpack("<{}{}".format(len(data) // sizeof_pvoid, "Q" if sizeof_pvoid == 8 else "I"), data))
+    pvoids = array(typecode)
+    if hasattr(pvoids, "frombytes"):
+        pvoids.frombytes(data)
+    else:
+        pvoids.fromstring(bytes(data))
+    if sys.byteorder != "little":
+        pvoids.byteswap()
+    return pvoids
 
-    return raw.decode("UTF-16le", "replace")
 
+def read_u32_array(data):
+    """Decode an array of 32 bit unsigned integers with a single call, see ``read_pvoid_array``.
+    """
+    return read_pvoid_array(data, 4)
 
-def read_utf16_multisz(io, size=-1):
-    i = 0
-    multisz = []
-    current = b""
-    is_word_done = False
-    while size == -1 or i < size:
-        wchar = io.read(2)
-        i += 2
-        if wchar == b"" or wchar == b"\x00\x00":
-            if is_word_done:
+
+UTF16_CHUNK_SIZE = 0x200  # the first read of a string with an unknown size, which is doubled until its end is found
+
+
+def _as_bytes(data):
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+
+def _find_aligned(data, sub, start=0):
+    """Find ``sub`` at an even offset of UTF-16 data from the (even) offset ``start``, or -1 if there is none.
+    Null bytes at an odd offset are the halves of two characters, so they are skipped.
+    """
+    i = data.find(sub, start)
+    while i != -1 and i & 1:
+        i = data.find(sub, i + 1)
+    return i
+
+
+def _decode_utf16(data, is_complete, at_eof):
+    """Decode the null terminated string at the beginning of UTF-16 data.
+
+    :param data: the UTF-16 data.
+    :param is_complete: False if the data may continue after its end.
+    :param at_eof: True if the data ends at the end of the stream.
+    :return: the string, the offset after its terminator and 0, or the whole data, its size and the number of reads of
+    the end of the stream that terminate it when reading character by character (if the data is complete). None if the
+    data is not complete and the string is not terminated in it yet.
+    """
+    end = _find_aligned(data, b"\x00\x00")
+    if end != -1:
+        return data[:end].decode("UTF-16le", "replace"), end + 2, 0
+    if not is_complete:
+        return None
+    return data.decode("UTF-16le", "replace"), len(data), 1
+
+
+def _decode_utf16_multisz(data, is_complete, at_eof):
+    """Decode the list of null terminated strings at the beginning of UTF-16 data, which ends with an empty string.
+    Returns the same as ``_decode_utf16``.
+    """
+    end = _find_aligned(data, b"\x00\x00\x00\x00")  # a terminator and an empty string
+    if end != -1:
+        return data[:end].decode("UTF-16le", "replace").split(u"\x00"), end + 4, 0
+    if not is_complete:
+        return None
+
+    strings = data.decode("UTF-16le", "replace").split(u"\x00")
+    if strings[-1]:
+        return strings, len(data), 2
+    if len(strings) > 1:
+        strings.pop()  # the data ends with a terminator
+        return strings, len(data), 1
+    # The end of the stream terminates an empty string
+    return strings if at_eof else [], len(data), 2
+
+
+def _read_utf16_field(io, size, decode):
+    """Read UTF-16 data with ``decode``, from a field of ``size`` bytes or of an unknown size (-1).
+
+    The stream is moved like when reading the data character by character, until the terminator or the end of the
+    field, and then to the end of the field. Reading the end of the stream counts as reading a null character.
+    """
+    if size == -1:
+        # Read growing chunks until the end of the data is found
+        data = b""
+        chunk_size = UTF16_CHUNK_SIZE
+        while True:
+            chunk = _as_bytes(io.read(chunk_size))
+            data += chunk
+            at_eof = len(chunk) < chunk_size
+            result = decode(data, at_eof, at_eof)
+            if result is not None:
                 break
-            is_word_done = True
-            multisz.append(current.decode("UTF-16le", "replace"))
-            current = b""
-        else:
-            is_word_done = False
-            current += wchar
-    if current:
-        multisz.append(current.decode("UTF-16le", "replace"))
-
-    if i < size:
-        io.seek(size - i, 1)
-
-    return multisz
+            chunk_size *= 2
+    else:
+        read_size = size + (size & 1)  # whole characters
+        data = _as_bytes(io.read(read_size))
+        at_eof = len(data) < read_size
+        result = decode(data, True, at_eof)
+    value, end, eof_reads = result
+
+    read_count = end  # the number of bytes the character by character loop counts
+    if at_eof and eof_reads:
+        read_count += end & 1
+        for _ in range(eof_reads):
+            if size != -1 and read_count >= size:
+                break
+            read_count += 2
+    offset = end - len(data)
+    if read_count < size:
+        offset += size - read_count  # skip the rest of the field
+    if offset:
+        io.seek(offset, 1)
+    return value
+
+
+def read_utf16(io, size=-1):
+    """Reads a null terminated UTF-16 string. If ``size`` is given, the string is in a field of ``size`` bytes and the
+    stream is moved to the end of the field.
+    """
+    return _read_utf16_field(io, size, _decode_utf16)
+
+
+def read_utf16_multisz(io, size=-1):
+    """Reads a list of null terminated UTF-16 strings which ends with an empty string (like REG_MULTI_SZ). If ``size``
+    is given, the list is in a field of ``size`` bytes and the stream is moved to the end of the field.
+    """
+    return _read_utf16_field(io, size, _decode_utf16_multisz)
+
+
+def decode_utf16(buffer):
+    """Decode a null terminated UTF-16 string from a buffer (bytes or a ``memoryview``, like a slice of a memory mapped
+    file), which ends at the end of the buffer if it has no terminator.
+    """
+    return _decode_utf16(_as_bytes(buffer), True, True)[0]
+
+
+def decode_utf16_multisz(buffer):
+    """Decode a list of null terminated UTF-16 strings from a buffer (bytes or a ``memoryview``).
+    """
+    return _decode_utf16_multisz(_as_bytes(buffer), True, True)[0]
 
 
 def read_filetime(io):
@@ -1,6 +1,5 @@
 from collections import namedtuple
-from io import BytesIO
-from struct import error, unpack
+from struct import Struct, error, unpack
 
 from procmon_parser.consts import EventClass, ProcessOperation, RegistryOperation, FilesystemOperation, \
     FilesystemSubOperations, FilesysemDirectoryControlOperation, RegistryTypes, RegistryKeyValueInformationClass, \
@@ -9,12 +8,13 @@ from procmon_parser.consts import EventClass, ProcessOperation, RegistryOperatio
     get_filesysyem_create_options, get_filesysyem_create_attributes, get_filesysyem_create_share_mode, \
     FilesystemOpenResult, get_filesysyem_io_flags, FilesystemPriority, get_ioctl_name, FileInformationClass, \
     get_filesystem_notify_change_flags, FilesystemSetInformationOperation, get_filesystem_createfilemapping_synctype, \
-    PageProtection
-from procmon_parser.stream_helper import read_u8, read_u16, read_u32, read_utf16, read_duration, \
+    PageProtection, EventClassOperation
+from procmon_parser.stream_helper import read_u8, read_u16, read_u32, read_utf16, \
     read_utf16_multisz, read_u64, read_filetime, read_s64
 
 PmlMetadata = namedtuple('PmlMetadata', ['str_idx', 'process_idx', 'hostname_idx', 'port_idx', 'read_pvoid',
-                                         'sizeof_pvoid', 'should_get_stacktrace', 'should_get_details'])
+                                         'sizeof_pvoid', 'should_get_stacktrace', 'should_get_details',
+                                         'stacktrace_table'])
 
 
 def get_enum_name_or(enum, val, default):
@@ -40,11 +40,16 @@ def get_sid_string(sid):
     return sid_string
 
 
+def get_detail_string_info(flags):
+    """Parses the info field about a detail string (contains is_ascii and number of characters)
+    """
+    return flags >> 15 == 1, flags & (2 ** 15 - 1)  # is_ascii, char_count
+
+
 def read_detail_string_info(io):
     """Reads the info field about a detail string (contains is_ascii and number of characters)
     """
-    flags = read_u16(io)
-    return flags >> 15 == 1, flags & (2 ** 15 - 1)  # is_ascii, char_count
+    return get_detail_string_info(read_u16(io))
 
 
 def read_detail_string(io, string_info):
@@ -61,8 +66,13 @@ def get_profiling_event_details(io, metadata, event, extra_detail_io):
     pass
 
 
+# flags, unknown field, length, source ip, destination ip, source port, destination port
+NetworkDetailsStruct = Struct("<H2xI16s16sHH")
+
+
 def get_network_event_details(io, metadata, event, extra_detail_io):
-    flags = read_u16(io)
+    flags, length, source_ip, dest_ip, source_port, dest_port = NetworkDetailsStruct.unpack(
+        io.read(NetworkDetailsStruct.size))
     is_source_ipv4 = flags & 1 != 0
     is_dest_ipv4 = flags & 2 != 0
     is_tcp = flags & 4 != 0
@@ -70,12 +80,7 @@ def get_network_event_details(io, metadata, event, extra_detail_io):
     protocol = "TCP" if is_tcp else "UDP"
     event.operation = protocol + " " + event.operation
 
-    io.seek(2, 1)  # Unknown field
-    event.details['Length'] = read_u32(io)
-    source_ip = io.read(16)
-    dest_ip = io.read(16)
-    source_port = read_u16(io)
-    dest_port = read_u16(io)
+    event.details['Length'] = length
 
     event.path = "{}:{} -> {}:{}".format(
         metadata.hostname_idx(source_ip, is_source_ipv4), metadata.port_idx(source_port, is_tcp),
@@ -300,38 +305,41 @@ RegistryExtraDetailsHandler = {
 }
 
 
+# The fixed fields of the details structure of registry operations after the path info (all of them start with an
+# unknown field), and the names of the fields in the information that is needed by the extra details structure
+RegistryOpenOrCreateKeyStruct = (Struct("<2xI"), ("desired_access",))
+RegistryQueryStruct = (Struct("<2xII"), ("length", "information_class"))
+RegistryEnumStruct = (Struct("<2xIII"), ("length", "index", "information_class"))
+RegistryDetailsStructs = {
+    RegistryOperation.RegOpenKey.name: RegistryOpenOrCreateKeyStruct,
+    RegistryOperation.RegCreateKey.name: RegistryOpenOrCreateKeyStruct,
+    RegistryOperation.RegQueryKey.name: RegistryQueryStruct,
+    RegistryOperation.RegQueryValue.name: RegistryQueryStruct,
+    RegistryOperation.RegEnumValue.name: RegistryEnumStruct,
+    RegistryOperation.RegEnumKey.name: RegistryEnumStruct,
+    RegistryOperation.RegSetInfoKey.name: (Struct("<2xI4xH2x"), ("key_set_information_class", "length")),
+    RegistryOperation.RegSetValue.name: (Struct("<2xIII"), ("reg_type", "length", "data_length")),
+}
+
+# Operations with the data of their extra details in the details structure itself
+RegistryDataInDetailsOperations = frozenset([
+    RegistryOperation.RegLoadKey.name, RegistryOperation.RegRenameKey.name,  # the new path
+    RegistryOperation.RegSetInfoKey.name, RegistryOperation.RegSetValue.name,
+])
+
+
 def get_registry_event_details(io, metadata, event, extra_detail_io):
     path_info = read_detail_string_info(io)
     details_info = dict()  # information that is needed by the extra details structure
 
-    if event.operation in [RegistryOperation.RegLoadKey.name, RegistryOperation.RegRenameKey.name]:
+    if event.operation in RegistryDetailsStructs:
+        details_struct, fields = RegistryDetailsStructs[event.operation]
+        details_info.update(zip(fields, details_struct.unpack(io.read(details_struct.size))))
+    elif event.operation in [RegistryOperation.RegLoadKey.name, RegistryOperation.RegRenameKey.name]:
         details_info["new_path_info"] = read_detail_string_info(io)
-        extra_detail_io = io  # the new path is a part of the details structure
-    elif event.operation in [RegistryOperation.RegOpenKey.name, RegistryOperation.RegCreateKey.name]:
-        io.seek(2, 1)  # Unknown field
-        details_info["desired_access"] = read_u32(io)
-    elif event.operation in [RegistryOperation.RegQueryKey.name, RegistryOperation.RegQueryValue.name]:
-        io.seek(2, 1)  # Unknown field
-        details_info["length"] = read_u32(io)
-        details_info["information_class"] = read_u32(io)
-    elif event.operation in [RegistryOperation.RegEnumValue.name, RegistryOperation.RegEnumKey.name]:
-        io.seek(2, 1)  # Unknown field
-        details_info["length"] = read_u32(io)
-        details_info["index"] = read_u32(io)
-        details_info["information_class"] = read_u32(io)
-    elif event.operation == RegistryOperation.RegSetInfoKey.name:
-        io.seek(2, 1)  # Unknown field
-        details_info["key_set_information_class"] = read_u32(io)
-        io.seek(4, 1)  # Unknown field
-        details_info["length"] = read_u16(io)
-        io.seek(2, 1)  # Unknown field
-        extra_detail_io = io  # For RegSetInfoKey the data is in the details structure
-    elif event.operation == RegistryOperation.RegSetValue.name:
-        io.seek(2, 1)  # Unknown field
-        details_info["reg_type"] = read_u32(io)
-        details_info["length"] = read_u32(io)
-        details_info["data_length"] = read_u32(io)
-        extra_detail_io = io  # For RegSetValue the data is in the details structure
+
+    if event.operation in RegistryDataInDetailsOperations:
+        extra_detail_io = io
 
     event.path = read_detail_string(io, path_info)
 
@@ -340,11 +348,15 @@ def get_registry_event_details(io, metadata, event, extra_detail_io):
         RegistryExtraDetailsHandler[event.operation](metadata, event, extra_detail_io, details_info)
 
 
-def get_filesystem_read_metadata_details(io, metadata, event, details_io, extra_detail_io):
+def get_filesystem_read_metadata_details(io, metadata, event, details, extra_detail_io):
     event.category = "Read Metadata"
 
 
-def get_filesystem_query_directory_details(io, metadata, event, details_io, extra_detail_io):
+# The file information class in the parameters of the operation, in 32 and 64 bit logs
+QueryDirectoryStructs = {4: Struct("<20xI"), 8: Struct("<28xI")}
+
+
+def get_filesystem_query_directory_details(io, metadata, event, details, extra_detail_io):
     event.category = "Read Metadata"
     directory_name_info = read_detail_string_info(io)
     directory_name = read_detail_string(io, directory_name_info)
@@ -352,14 +364,8 @@ def get_filesystem_query_directory_details(io, metadata, event, details_io, extr
         event.path = event.path + directory_name if event.path[-1] == "\\" else event.path + "\\" + directory_name
         event.details['Filter'] = directory_name
 
-    details_io.seek(0x10, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
-    details_io.seek(0x4, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
-
-    file_information_class = FileInformationClass(read_u32(details_io))
+    file_information_class = FileInformationClass(
+        QueryDirectoryStructs[metadata.sizeof_pvoid].unpack_from(details)[0])
     event.details["FileInformationClass"] = file_information_class.name
 
     if extra_detail_io and file_information_class in [FileInformationClass.FileDirectoryInformation,
@@ -424,40 +430,37 @@ def get_filesystem_query_directory_details(io, metadata, event, details_io, extr
             continue
 
 
-def get_filesystem_notify_change_directory_details(io, metadata, event, details_io, extra_detail_io):
+# The completion filter in the parameters of the operation
+NotifyChangeDirectoryStructs = {4: Struct("<16xI"), 8: Struct("<20xI")}
+
+
+def get_filesystem_notify_change_directory_details(io, metadata, event, details, extra_detail_io):
     event.category = "Read Metadata"
+    notify_flags = NotifyChangeDirectoryStructs[metadata.sizeof_pvoid].unpack_from(details)[0]
+    event.details["Filter"] = get_filesystem_notify_change_flags(notify_flags)
 
-    details_io.seek(0x10, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
 
-    event.details["Filter"] = get_filesystem_notify_change_flags(read_u32(details_io))
+# desired access, length of the impersonating SID and padding
+CreateFileStruct = Struct("<IB3x")
 
+# disposition and options, attributes, share mode and allocation size in the parameters of the operation
+CreateFileParametersStructs = {4: Struct("<16xIHH12xI"), 8: Struct("<20xI4xHH20xI")}
 
-def get_filesystem_create_file_details(io, metadata, event, details_io, extra_detail_io):
-    event.details["Desired Access"] = get_filesystem_access_mask_string(read_u32(io))
-    impersonating_sid_length = read_u8(io)
-    io.seek(0x3, 1)  # padding
 
-    details_io.seek(0x10, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
+def get_filesystem_create_file_details(io, metadata, event, details, extra_detail_io):
+    desired_access, impersonating_sid_length = CreateFileStruct.unpack(io.read(CreateFileStruct.size))
+    event.details["Desired Access"] = get_filesystem_access_mask_string(desired_access)
 
-    disposition_and_options = read_u32(details_io)
+    disposition_and_options, attributes, share_mode, allocation = \
+        CreateFileParametersStructs[metadata.sizeof_pvoid].unpack_from(details)
     disposition = disposition_and_options >> 0x18
     options = disposition_and_options & 0xffffff
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
-    attributes = read_u16(details_io)
-    share_mode = read_u16(details_io)
 
     event.details["Disposition"] = get_enum_name_or(FilesystemDisposition, disposition, "<unknown>")
     event.details["Options"] = get_filesysyem_create_options(options)
     event.details["Attributes"] = get_filesysyem_create_attributes(attributes)
     event.details["ShareMode"] = get_filesysyem_create_share_mode(share_mode)
 
-    details_io.seek(0x4 + metadata.sizeof_pvoid * 2, 1)
-    allocation = read_u32(details_io)
     allocation_value = allocation if disposition in [FilesystemDisposition.Supersede, FilesystemDisposition.Create,
                                                      FilesystemDisposition.OpenIf,
                                                      FilesystemDisposition.OverwriteIf] else "n/a"
@@ -481,7 +484,11 @@ def get_filesystem_create_file_details(io, metadata, event, details_io, extra_de
         event.category = "Write"
 
 
-def get_filesystem_create_file_mapping(io, metadata, event, details_io, extra_detail_io):
+# sync type and page protection, 0xC bytes from the beginning of the parameters of the operation
+CreateFileMappingStruct = Struct("<12xII")
+
+
+def get_filesystem_create_file_mapping(io, metadata, event, details, extra_detail_io):
     """Get detailed information about a FileSystem CreateFileMapping event.
 
     Notes:
@@ -491,9 +498,8 @@ def get_filesystem_create_file_mapping(io, metadata, event, details_io, extra_de
     """
     # Only two fields are read from the details (there's also the detail string which is already read in the caller, see
     # get_filesystem_event_details() function). Besides those, all other fields seem to be completely ignored.
-    details_io.seek(0x0C, 1)  # skip 0xC bytes from the beginning of details.
-    sync_type = read_u32(details_io)  # note: asm uses 'movsxd', so it's signed with sign extension.
-    page_protection = read_u32(details_io)
+    # note: asm uses 'movsxd' for the sync type, so it's signed with sign extension.
+    sync_type, page_protection = CreateFileMappingStruct.unpack_from(details)
     event.details["SyncType"] = get_filesystem_createfilemapping_synctype(sync_type)
 
     if page_protection & PageProtection.PAGE_READONLY:
@@ -513,20 +519,15 @@ def get_filesystem_create_file_mapping(io, metadata, event, details_io, extra_de
         event.details["PageProtection"] += "|PAGE_NOCACHE"
 
 
-def get_filesystem_read_write_file_details(io, metadata, event, details_io, extra_detail_io):
+# I/O flags and priority, length and offset in the parameters of the operation
+ReadWriteFileStructs = {4: Struct("<4xI4xI4xq"), 8: Struct("<4xI4xI12xq")}
+
+
+def get_filesystem_read_write_file_details(io, metadata, event, details, extra_detail_io):
     event.category = "Read" if event.operation == "ReadFile" else "Write"
-    details_io.seek(0x4, 1)
-    io_flags_and_priority = read_u32(details_io)
+    io_flags_and_priority, length, offset = ReadWriteFileStructs[metadata.sizeof_pvoid].unpack_from(details)
     io_flags = io_flags_and_priority & 0xe000ff
     priority = (io_flags_and_priority >> 0x11) & 7
-    details_io.seek(0x4, 1)
-    length = read_u32(details_io)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
-    details_io.seek(0x4, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
-    offset = read_s64(details_io)
 
     event.details["Offset"] = offset
     if extra_detail_io:
@@ -540,18 +541,12 @@ def get_filesystem_read_write_file_details(io, metadata, event, details_io, extr
         event.details["Priority"] = FilesystemPriority.get(priority, "0x{:x}".format(priority))
 
 
-def get_filesystem_ioctl_details(io, metadata, event, details_io, extra_detail_io):
-    details_io.seek(0x8, 1)
-    write_length = read_u32(details_io)
-    read_length = read_u32(details_io)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
+# write length, read length and the control code in the parameters of the operation
+IoctlStructs = {4: Struct("<8xII4xI"), 8: Struct("<8xII12xI")}
 
-    details_io.seek(0x4, 1)
-    if metadata.sizeof_pvoid == 8:
-        details_io.seek(4, 1)  # Padding for 64 bit
 
-    ioctl = read_u32(details_io)
+def get_filesystem_ioctl_details(io, metadata, event, details, extra_detail_io):
+    write_length, read_length, ioctl = IoctlStructs[metadata.sizeof_pvoid].unpack_from(details)
     event.details["Control"] = get_ioctl_name(ioctl)
     if event.details["Control"] in ["FSCTL_OFFLOAD_READ", "FSCTL_GET_REPARSE_POINT", "FSCTL_READ_RAW_ENCRYPTED"]:
         event.category = "Read"
@@ -580,7 +575,6 @@ def get_filesystem_ioctl_details(io, metadata, event, details_io, extra_detail_i
         if event.details["Control"] == "FSCTL_PIPE_INTERNAL_WRITE":
             event.details["Length"] = write_length
         elif event.details["Control"] == "FSCTL_OFFLOAD_READ":
-            details_io.seek(0x8, 1)
             event.details["Offset"] = read_s64(io)
             event.details["Length"] = read_u64(io)
         elif event.details["Control"] == "FSCTL_OFFLOAD_WRITE":
@@ -593,7 +587,7 @@ def get_filesystem_ioctl_details(io, metadata, event, details_io, extra_detail_i
             event.details["ReadLength"] = read_length
 
 
-def get_filesystem_setdispositioninformation_details(io, metadata, event, details_io, extra_detail_io):
+def get_filesystem_setdispositioninformation_details(io, metadata, event, details, extra_detail_io):
     is_delete = bool(read_u8(io))
     io.seek(3, 1)  # Padding
 
@@ -620,9 +614,16 @@ FilesystemSubOperationHandler = {
 }
 
 
+# The sub operation, the parameters of the operation (5 pointers and 0x14 more bytes) and the path info, in 32 and
+# 64 bit logs
+FilesystemDetailsStructs = {
+    sizeof_pvoid: Struct("<B3x{}sH2x".format(sizeof_pvoid * 5 + 0x14)) for sizeof_pvoid in (4, 8)
+}
+
+
 def get_filesystem_event_details(io, metadata, event, extra_detail_io):
-    sub_operation = read_u8(io)
-    io.seek(0x3, 1)  # padding
+    details_struct = FilesystemDetailsStructs[metadata.sizeof_pvoid]
+    sub_operation, details, path_flags = details_struct.unpack(io.read(details_struct.size))
 
     # fix operation name if there is more specific sub operation
     if 0 != sub_operation and FilesystemOperation[event.operation] in FilesystemSubOperations:
@@ -631,45 +632,45 @@ def get_filesystem_event_details(io, metadata, event, extra_detail_io):
         except ValueError:
             event.operation += " <Unknown>"
 
-    details_io = BytesIO(io.read(metadata.sizeof_pvoid * 5 + 0x14))
-    path_info = read_detail_string_info(io)
-    io.seek(2, 1)  # Padding
-    event.path = read_detail_string(io, path_info)
+    event.path = read_detail_string(io, get_detail_string_info(path_flags))
     if metadata.should_get_details and event.operation in FilesystemSubOperationHandler:
-        FilesystemSubOperationHandler[event.operation](io, metadata, event, details_io, extra_detail_io)
+        FilesystemSubOperationHandler[event.operation](io, metadata, event, details, extra_detail_io)
+
+
+# pid, the sizes of two unknown fields, path info and command line info, between unknown fields
+ProcessCreatedStruct = Struct("<4xI36xBBHH2x")
 
 
 def get_process_created_details(io, metadata, event, extra_detail_io):
-    io.seek(4, 1)  # Unknown fields
-    event.details["PID"] = read_u32(io)
-    io.seek(0x24, 1)  # Unknown fields
-    unknown_size1 = read_u8(io)
-    unknown_size2 = read_u8(io)
-    path_info = read_detail_string_info(io)
-    command_line_info = read_detail_string_info(io)
-    io.seek(2 + unknown_size1 + unknown_size2, 1)  # Unknown fields
-    event.path = read_detail_string(io, path_info)
-    event.details["Command line"] = read_detail_string(io, command_line_info)
+    pid, unknown_size1, unknown_size2, path_flags, command_line_flags = ProcessCreatedStruct.unpack(
+        io.read(ProcessCreatedStruct.size))
+    event.details["PID"] = pid
+    io.seek(unknown_size1 + unknown_size2, 1)  # Unknown fields
+    event.path = read_detail_string(io, get_detail_string_info(path_flags))
+    event.details["Command line"] = read_detail_string(io, get_detail_string_info(command_line_flags))
+
+
+# parent pid, command line info, current directory info and the number of characters in the environment
+ProcessStartedStruct = Struct("<IHHI")
 
 
 def get_process_started_details(io, metadata, event, extra_detail_io):
-    event.details["Parent PID"] = read_u32(io)
-    command_line_info = read_detail_string_info(io)
-    current_directory_info = read_detail_string_info(io)
-    environment_character_count = read_u32(io)
-    event.details["Command line"] = read_detail_string(io, command_line_info)
-    event.details["Current directory"] = read_detail_string(io, current_directory_info)
+    parent_pid, command_line_flags, current_directory_flags, environment_character_count = \
+        ProcessStartedStruct.unpack(io.read(ProcessStartedStruct.size))
+    event.details["Parent PID"] = parent_pid
+    event.details["Command line"] = read_detail_string(io, get_detail_string_info(command_line_flags))
+    event.details["Current directory"] = read_detail_string(io, get_detail_string_info(current_directory_flags))
     event.details["Environment"] = read_utf16_multisz(io, environment_character_count * 2)
 
 
+# exit status, kernel time, user time, working set, peak working set, private bytes and peak private bytes
+ProcessExitStruct = Struct("<IQQQQQQ")
+
+
 def get_process_exit_details(io, metadata, event, extra_details_io):
-    event.details["Exit Status"] = read_u32(io)
-    kernel_time = read_duration(io)
-    user_time = read_duration(io)
-    working_set = read_u64(io)
-    peak_working_set = read_u64(io)
-    private_bytes = read_u64(io)
-    peak_private_bytes = read_u64(io)
+    exit_status, kernel_time, user_time, working_set, peak_working_set, private_bytes, peak_private_bytes = \
+        ProcessExitStruct.unpack(io.read(ProcessExitStruct.size))
+    event.details["Exit Status"] = exit_status
 
     event.details["User Time"] = user_time
     event.details["Kernel Time"] = kernel_time
@@ -679,23 +680,29 @@ def get_process_exit_details(io, metadata, event, extra_details_io):
     event.details["Peak Working Set"] = peak_working_set
 
 
+# image base, image size, path info and an unknown field, in 32 and 64 bit logs
+LoadImageStructs = {4: Struct("<IIH2x"), 8: Struct("<QIH2x")}
+
+
 def get_load_image_details(io, metadata, event, extra_detail_io):
-    event.details["Image Base"] = metadata.read_pvoid(io)
-    event.details["Image Size"] = read_u32(io)
-    path_info = read_detail_string_info(io)
-    io.seek(2, 1)  # Unknown field
-    event.path = read_detail_string(io, path_info)
+    load_image_struct = LoadImageStructs[metadata.sizeof_pvoid]
+    image_base, image_size, path_flags = load_image_struct.unpack(io.read(load_image_struct.size))
+    event.details["Image Base"] = image_base
+    event.details["Image Size"] = image_size
+    event.path = read_detail_string(io, get_detail_string_info(path_flags))
 
 
 def get_thread_create_details(io, metadata, event, extra_detail_io):
     event.details["Thread ID"] = read_u32(io)
 
 
+# kernel time and user time, after unknown fields
+ThreadExitStruct = Struct("<4xQQ")
+
+
 def get_thread_exit_details(io, metadata, event, extra_detail_io):
     event.details["Thread ID"] = event.tid
-    io.seek(4, 1)  # Unknown fields
-    kernel_time = read_duration(io)
-    user_time = read_duration(io)
+    kernel_time, user_time = ThreadExitStruct.unpack(io.read(ThreadExitStruct.size))
     event.details["User Time"] = user_time
     event.details["Kernel Time"] = kernel_time
 
@@ -726,6 +733,63 @@ ClassEventDetailsHandler = {
 }
 
 
+def get_operation_details_handler(event_class, operation):
+    """Get the function that reads the details of an operation, or None if its details are not supported.
+    """
+    if event_class == EventClass.Process:
+        return ProcessSpecificOperationHandler.get(operation.name)
+    return ClassEventDetailsHandler[event_class]
+
+
+# (event class value, operation value) -> (EventClass, operation name, details handler), so the event class and the
+# operation of an event are resolved with a single lookup instead of constructing enums for every event.
+EventOperationsTable = {
+    (event_class.value, operation.value): (event_class, operation.name,
+                                           get_operation_details_handler(event_class, operation))
+    for event_class, operation_enum in EventClassOperation.items() for operation in operation_enum
+}
+
+
+def resolve_event_operation(event_class_value, operation_value):
+    """Get the EventClass, the operation name and the details handler of the raw event class and operation values.
+    """
+    try:
+        return EventOperationsTable[(event_class_value, operation_value)]
+    except KeyError:
+        # Not a known operation, so let the enums raise their errors about the values
+        event_class = EventClass(event_class_value)
+        operation = EventClassOperation[event_class](operation_value)
+        return event_class, operation.name, get_operation_details_handler(event_class, operation)
+
+
+def _get_detailed_operation_names(event_class, operation):
+    """Get all the operation names that the details of an event can refine its operation to, see
+    ``get_network_event_details`` and ``get_filesystem_event_details``. Returns None if the operation is final.
+    """
+    if event_class == EventClass.Network:
+        return tuple(protocol + " " + operation.name for protocol in ("TCP", "UDP"))
+    if event_class == EventClass.File_System and operation in FilesystemSubOperations:
+        return (operation.name, operation.name + " <Unknown>") + \
+            tuple(sub_operation.name for sub_operation in FilesystemSubOperations[operation])
+    return None
+
+
+# (EventClass, operation name) -> the operation names that the details can refine the operation to, for the operations
+# that the details can change
+DetailedOperationNamesTable = {
+    (event_class, operation.name): _get_detailed_operation_names(event_class, operation)
+    for event_class, operation_enum in EventClassOperation.items() for operation in operation_enum
+    if _get_detailed_operation_names(event_class, operation) is not None
+}
+
+
+def get_detailed_operation_names(event_class, operation_name):
+    """Get the operation names that an event can have after its details are parsed, or None if its operation doesn't
+    depend on the details.
+    """
+    return DetailedOperationNamesTable.get((event_class, operation_name))
+
+
 def get_event_details(detail_stream, metadata, event, extra_detail_stream):
     """Calculates the specific details of the event in the stream. The stream should be after the common
     information of the event.
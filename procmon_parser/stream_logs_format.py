@@ -1,13 +1,28 @@
+import datetime
+import functools
+import itertools
+import mmap
+import os
 from collections import OrderedDict
 from io import BytesIO
-from struct import Struct
+from struct import Struct, unpack_from
 from ipaddress import IPv4Address, IPv6Address
 
-from procmon_parser.consts import EventClass, EventClassOperation
-from procmon_parser.logs import PMLStructReader, Module, Process, Event, PMLError
-from procmon_parser.stream_helper import read_u8, read_u16, read_u32, read_u64, read_utf16, read_filetime, \
-    get_pvoid_reader, get_pvoid_size
-from procmon_parser.stream_logs_detail_format import PmlMetadata, get_event_details
+from six import PY2
+
+# numpy is optional here: scan_columns requires it, and with it the events offsets array is decoded to views of the
+# file instead of Python arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from procmon_parser.filters import compile_where, compile_rules, where_mask
+from procmon_parser.logs import PMLStructReader, Module, LazyProcess, Event, CompactEvent, CompactEventDetails, \
+    LazyEvent, StacktraceTable, PMLError, datetime_to_filetime
+from procmon_parser.stream_helper import read_u16, read_u32, read_u64, read_utf16, \
+    get_pvoid_reader, get_pvoid_size, read_pvoid_array, read_u32_array, BufferStream, PositionalStream
+from procmon_parser.stream_logs_detail_format import PmlMetadata, resolve_event_operation, get_detailed_operation_names
 
 
 class Header(object):
@@ -57,99 +72,239 @@ class Header(object):
             raise PMLError("PML is corrupt and cannot be opened.")
 
 
-class EventOffsetsArray(list):
-    def __init__(self, io, total_size, number_of_events):
-        super(EventOffsetsArray, self).__init__()
-        stream = BytesIO(io.read(total_size))
-        offsets = [0] * number_of_events
-        for i in range(number_of_events):
-            offsets[i] = read_u32(stream)
-            _ = read_u8(stream)  # Unknown flags
-        self.extend(offsets)
+class EventOffsetsArray(object):
+    """The offsets of the events in the PML file, and the (unknown) flags byte of every event.
 
+    The entries of the events offsets array are decoded with a single call: to numpy views of the array when numpy is
+    available, so slicing doesn't copy them, or to an ``array`` of the offsets and a ``bytearray`` of the flags
+    otherwise.
+    Indexing gives the offset of an event as an int, and slicing gives another ``EventOffsetsArray``.
+    """
+    ENTRY_SIZE = 5  # the offset (Uint32) and the flags (Uint8) of an event
+    ITER_CHUNK_SIZE = 0x10000  # the number of offsets that are converted to ints together when iterating
 
-class StringsTable(list):
-    def __init__(self, io):
-        super(StringsTable, self).__init__()
-        string_table_start = io.tell()
-        number_of_strings = read_u32(io)
+    def __init__(self, offsets, flags):
+        self._offsets = offsets
+        self._flags = flags
+
+    @classmethod
+    def read(cls, io, total_size, number_of_events):
+        """Read the events offsets array that the stream points to.
+
+        :param io: the stream.
+        :param total_size: the size of the events offsets array in the file.
+        :param number_of_events: the number of events in the log.
+        """
+        size = number_of_events * cls.ENTRY_SIZE
+        if size > total_size:
+            raise PMLError("PML is corrupt, the events offsets array is too small")
+        data = io.read(size)
+        if isinstance(data, memoryview):
+            data = data.tobytes()  # don't keep a view of a memory mapped file
+        if len(data) != size:
+            raise PMLError("PML is corrupt, the events offsets array is truncated")
+
+        if numpy is not None:
+            entries = numpy.frombuffer(data, dtype=numpy.dtype([("offset", "<u4"), ("flags", "u1")]),
+                                       count=number_of_events)
+            return cls(entries["offset"], entries["flags"])
+
+        # Gather the bytes of the offsets out of the entries with strided slices
+        offsets_data = bytearray(number_of_events * 4)
+        for i in range(4):
+            offsets_data[i::4] = data[i::cls.ENTRY_SIZE]
+        return cls(read_u32_array(bytes(offsets_data)), bytearray(data[4::cls.ENTRY_SIZE]))
+
+    @property
+    def offsets(self):
+        """The offsets of the events, as a numpy array or an ``array``.
+        """
+        return self._offsets
+
+    @property
+    def flags(self):
+        """The flags of the events, as a numpy array or a ``bytearray``.
+        """
+        return self._flags
 
-        strings_offsets_array = [read_u32(io) for _ in range(number_of_strings)]
+    def __len__(self):
+        return len(self._offsets)
 
-        strings = [''] * number_of_strings
-        for i, offset in enumerate(strings_offsets_array):
-            io.seek(string_table_start + offset, 0)
-            string_size = read_u32(io)
-            strings[i] = read_utf16(io, string_size)
-        self.extend(strings)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EventOffsetsArray(self._offsets[index], self._flags[index])
+        return int(self._offsets[index])
+
+    def __iter__(self):
+        # Convert the offsets to ints in chunks, which is a lot faster than converting them one by one, without
+        # creating all the ints at once
+        offsets = self._offsets
+        chunk_size = self.ITER_CHUNK_SIZE
+        return itertools.chain.from_iterable(
+            offsets[start:start + chunk_size].tolist() for start in range(0, len(offsets), chunk_size))
+
+
+class StringsTable(object):
+    """The strings table of a PML file. Only the offsets of the strings are read when the table is opened, and every
+    string is decoded on its first access.
+    """
+
+    def __init__(self, io, stream_at=None, cache=True):
+        """
+        :param io: a stream that points to the strings table.
+        :param stream_at: a function that returns a stream of its own which points to an offset of the file, for
+        reading the strings later. By default the strings are read from ``io``, which is moved back to where it was.
+        :param cache: True to keep the strings that were decoded, so every string is decoded only once.
+        """
+        self._table_start = io.tell()
+        number_of_strings = read_u32(io)
+        self._offsets = read_u32_array(io.read(number_of_strings * 4))
+        if len(self._offsets) != number_of_strings:
+            raise PMLError("The strings table is truncated")
+        self._stream_at = stream_at
+        self._io = io
+        self._cache = {} if cache else None
+
+    def __read_string(self, offset):
+        if self._stream_at is not None:
+            stream = self._stream_at(offset)
+            return read_utf16(stream, read_u32(stream))
+        position = self._io.tell()
+        try:
+            self._io.seek(offset, 0)
+            return read_utf16(self._io, read_u32(self._io))
+        finally:
+            self._io.seek(position, 0)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if self._cache is not None:
+            string = self._cache.get(index)
+            if string is not None:
+                return string
+        string = self.__read_string(self._table_start + self._offsets[index])
+        if self._cache is not None:
+            self._cache[index] = string
+        return string
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+# The fields of a process structure before its modules, in 32 and 64 bit logs: process index, pid, parent pid,
+# authentication id, session, start time, end time, virtualized, is 64 bit, the string indexes of the integrity, user,
+# process name, image path, command line, company, version and description, and the number of modules
+ProcessStructs = {
+    sizeof_pvoid: Struct("<III4xQI4xQQII8I8x{}xI".format(sizeof_pvoid)) for sizeof_pvoid in (4, 8)
+}
+
+# The fields of a module structure: base address, size, the string indexes of the image path, version, company and
+# description, and the timestamp
+ModuleStructs = {4: Struct("<4xIIIIIII24x"), 8: Struct("<8xQIIIIII24x")}
 
 
 class ProcessTable(dict):
-    def __init__(self, io, read_pvoid, strings_table):
+    """The process table of a PML file. Only the offsets of the processes are read when the table is opened. Every
+    process is decoded when it is first accessed, and its modules when they are first accessed (see ``LazyProcess``).
+    """
+
+    def __init__(self, io, sizeof_pvoid, strings_table, stream_at=None):
+        """
+        :param io: a stream that points to the process table.
+        :param sizeof_pvoid: the size of a pointer in the log.
+        :param strings_table: the strings table of the log.
+        :param stream_at: a function that returns a stream of its own which points to an offset of the file, for
+        reading the processes later. By default they are read from ``io``, which is moved back to where it was.
+        """
         super(ProcessTable, self).__init__()
-        self._read_pvoid = read_pvoid
+        self._io = io
+        self._stream_at = stream_at
         self._strings_table = strings_table
+        self._process_struct = ProcessStructs[sizeof_pvoid]
+        self._module_struct = ModuleStructs[sizeof_pvoid]
+
         process_table_start = io.tell()
         number_of_processes = read_u32(io)
-
-        # The array of process indexes is not essential becuase they appear in the process structure itself.
-        # process_index_array = [read_u32(io) for _ in range(number_of_processes)]
-        io.seek(number_of_processes * 4, 1)  # jump over the process indexes array
-
-        process_offsets_array = [read_u32(io) for _ in range(number_of_processes)]
-        for offset in process_offsets_array:
-            io.seek(process_table_start + offset, 0)
-            process_index, process = self.__read_process(io)
-            self[process_index] = process
-
-    def __read_process(self, stream):
-        process_index = read_u32(stream)
-        pid = read_u32(stream)
-        parent_pid = read_u32(stream)
-
-        stream.seek(4, 1)  # Unknown field
-        authentication_id = read_u64(stream)
-        session = read_u32(stream)
-
-        stream.seek(4, 1)  # Unknown field
-        start_time = read_filetime(stream)
-        end_time = read_filetime(stream)
-        virtualized = read_u32(stream)
-        is_process_64bit = read_u32(stream)
-
-        integrity = self._strings_table[read_u32(stream)]
-        user = self._strings_table[read_u32(stream)]
-        process_name = self._strings_table[read_u32(stream)]
-        image_path = self._strings_table[read_u32(stream)]
-        command_line = self._strings_table[read_u32(stream)]
-        company = self._strings_table[read_u32(stream)]
-        version = self._strings_table[read_u32(stream)]
-        description = self._strings_table[read_u32(stream)]
-
-        icon_index_small = read_u32(stream)
-        icon_index_big = read_u32(stream)
-        _ = self._read_pvoid(stream)  # Unknown field
-        number_of_modules = read_u32(stream)
-        modules = [self.__read_module(stream) for _ in range(number_of_modules)]
-        return process_index, Process(pid=pid, parent_pid=parent_pid, authentication_id=authentication_id,
-                                      session=session, virtualized=virtualized, is_process_64bit=is_process_64bit,
-                                      integrity=integrity, user=user, process_name=process_name, image_path=image_path,
-                                      command_line=command_line, company=company, version=version,
-                                      description=description, start_time=start_time, end_time=end_time,
-                                      modules=modules)
-
-    def __read_module(self, stream):
-        _ = self._read_pvoid(stream)  # Unknown field
-        base_address = self._read_pvoid(stream)
-        size = read_u32(stream)
-        image_path = self._strings_table[read_u32(stream)]
-        version = self._strings_table[read_u32(stream)]
-        company = self._strings_table[read_u32(stream)]
-        description = self._strings_table[read_u32(stream)]
-        timestamp = read_u32(stream)
-        stream.seek(0x18, 1)  # Unknown field
-        return Module(base_address=base_address, size=size, path=image_path, version=version, company=company,
-                      description=description, timestamp=timestamp)
+        # The process indexes are also in the process structures themselves
+        process_indexes = read_u32_array(io.read(number_of_processes * 4))
+        process_offsets = read_u32_array(io.read(number_of_processes * 4))
+        if len(process_offsets) != number_of_processes:
+            raise PMLError("The process table is truncated")
+        self._offsets = OrderedDict(
+            (process_index, process_table_start + offset) for process_index, offset in zip(process_indexes,
+                                                                                          process_offsets))
+
+    def __read_at(self, offset, size):
+        if self._stream_at is not None:
+            return self._stream_at(offset).read(size)
+        position = self._io.tell()
+        try:
+            self._io.seek(offset, 0)
+            return self._io.read(size)
+        finally:
+            self._io.seek(position, 0)
+
+    def __missing__(self, process_index):
+        process = self.__read_process(self._offsets[process_index])
+        return self.setdefault(process_index, process)  # another thread may have read it in the meantime
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, process_index):
+        return process_index in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def get(self, process_index, default=None):
+        return self[process_index] if process_index in self._offsets else default
+
+    def keys(self):
+        return list(self._offsets)
+
+    def values(self):
+        return [self[process_index] for process_index in self._offsets]
+
+    def items(self):
+        return [(process_index, self[process_index]) for process_index in self._offsets]
+
+    def load_modules(self):
+        """Load the modules of the processes that were already decoded, so they don't need the file anymore.
+        """
+        for process in list(dict.values(self)):
+            if isinstance(process, LazyProcess):
+                process.load()
+
+    def __read_process(self, offset):
+        process_struct = self._process_struct
+        fields = process_struct.unpack(self.__read_at(offset, process_struct.size))
+        _, pid, parent_pid, authentication_id, session, start_time, end_time, virtualized, is_process_64bit = fields[:9]
+        integrity, user, process_name, image_path, command_line, company, version, description = \
+            [self._strings_table[string_index] for string_index in fields[9:17]]
+        number_of_modules = fields[17]
+        modules_loader = functools.partial(self.__read_modules, offset + process_struct.size, number_of_modules)
+        return LazyProcess(modules_loader, number_of_modules, pid=pid, parent_pid=parent_pid,
+                           authentication_id=authentication_id, session=session, virtualized=virtualized,
+                           is_process_64bit=is_process_64bit, integrity=integrity, user=user,
+                           process_name=process_name, image_path=image_path, command_line=command_line,
+                           company=company, version=version, description=description, start_time=start_time,
+                           end_time=end_time)
+
+    def __read_modules(self, offset, number_of_modules):
+        module_struct = self._module_struct
+        data = self.__read_at(offset, number_of_modules * module_struct.size)
+        modules = []
+        for i in range(number_of_modules):
+            base_address, size, image_path, version, company, description, timestamp = module_struct.unpack_from(
+                data, i * module_struct.size)
+            modules.append(Module(base_address=base_address, size=size, path=self._strings_table[image_path],
+                                  version=self._strings_table[version], company=self._strings_table[company],
+                                  description=self._strings_table[description], timestamp=timestamp))
+        return modules
 
 
 class HostnamesTable(dict):
@@ -176,33 +331,74 @@ class PortsTable(dict):
 
 
 CommonEventStruct = Struct("<IIIHHIQQIHHII")
+EVENT_DATE_OFFSET = 0x1c  # the offset of the date field in CommonEventStruct
 
+# The name, type and offset of every known field of CommonEventStruct, for reading it as columns
+CommonEventColumns = [
+    ("process_index", "<u4", 0x0),
+    ("tid", "<u4", 0x4),
+    ("event_class", "<u4", 0x8),
+    ("operation", "<u2", 0xc),
+    ("duration", "<u8", 0x14),
+    ("date_filetime", "<u8", 0x1c),
+    ("result", "<u4", 0x24),
+    ("stacktrace_depth", "<u2", 0x28),
+    ("details_size", "<u4", 0x2c),
+    ("extra_details_offset", "<u4", 0x30),
+]
 
-def read_event(io, metadata):
-    """Reads the event that the stream points to.
+
+# The pid of events whose process index is not in the process table
+UNKNOWN_PID = -1
+
+
+def get_pid_column(process_table, process_indexes):
+    """Get the pids of the processes of a numpy array of process indexes.
+
+    :param process_table: dictionary of process index to Process.
+    :param process_indexes: a numpy array of process indexes, like the "process_index" column of the events.
+    :return: a numpy array of int64 pids, with ``UNKNOWN_PID`` for the process indexes that are not in the table.
+    """
+    pids = numpy.full(len(process_indexes), UNKNOWN_PID, dtype=numpy.int64)
+    if not process_table:
+        return pids
+    sorted_process_indexes = numpy.array(sorted(process_table), dtype=numpy.uint32)
+    table_pids = numpy.array([process_table[i].pid for i in sorted_process_indexes], dtype=numpy.int64)
+    positions = numpy.minimum(numpy.searchsorted(sorted_process_indexes, process_indexes), len(table_pids) - 1)
+    known = sorted_process_indexes[positions] == process_indexes
+    pids[known] = table_pids[positions[known]]
+    return pids
+
+
+def read_stacktrace(data, metadata):
+    """Decodes the raw stack trace of an event to an array of frame addresses, or to the shared tuple of the stack trace
+    if the stack traces are interned.
+    """
+    if metadata.stacktrace_table is not None:
+        return metadata.stacktrace_table.intern(data)
+    return read_pvoid_array(data, metadata.sizeof_pvoid)
+
+
+def read_event_parts(io, metadata, common_fields=None):
+    """Reads the parts of the event that the stream points to, without parsing them.
 
     :param io: the stream.
     :param metadata: metadata of the PML file.
-    :return: Event object.
+    :param common_fields: the CommonEventStruct fields if they were already read, then the stream points right after
+    them.
+    :return: the CommonEventStruct fields, the raw stack trace (empty if the stack trace is not needed), the stream of
+    the details structure and the stream of the extra details structure (None if the event has no extra details).
     """
-    process_idx, tid, event_class_val, operation_val, _, _, duration, date, result, stacktrace_depth, _, \
-        details_size, extra_details_offset = CommonEventStruct.unpack(io.read(CommonEventStruct.size))
-
-    process = metadata.process_idx(process_idx)
-    event_class = EventClass(event_class_val)
-    operation = EventClassOperation[event_class](operation_val)
+    if common_fields is None:
+        common_fields = CommonEventStruct.unpack(io.read(CommonEventStruct.size))
+    stacktrace_depth, details_size, extra_details_offset = common_fields[9], common_fields[11], common_fields[12]
 
     sizeof_stacktrace = stacktrace_depth * metadata.sizeof_pvoid
     if metadata.should_get_stacktrace:
-        stream = BytesIO(io.read(sizeof_stacktrace))
-        stacktrace = [metadata.read_pvoid(stream) for _ in range(stacktrace_depth)]
+        raw_stacktrace = io.read(sizeof_stacktrace)
     else:
         io.seek(sizeof_stacktrace, 1)
-        stacktrace = []
-
-    details = OrderedDict()
-    event = Event(process=process, tid=tid, event_class=event_class, operation=operation, duration=duration,
-                  date_filetime=date, result=result, stacktrace=stacktrace, category='', path='', details=details)
+        raw_stacktrace = b""
 
     details_stream = BytesIO(io.read(details_size))
     extra_details_stream = None
@@ -217,33 +413,215 @@ def read_event(io, metadata):
         extra_details_stream_size = read_u16(io)
         extra_details_stream = BytesIO(io.read(extra_details_stream_size))
         io.seek(current_offset, 0)
-    get_event_details(details_stream, metadata, event, extra_details_stream)
+    return common_fields, raw_stacktrace, details_stream, extra_details_stream
+
+
+def read_event_parts_from_buffer(buffer, offset, metadata, common_fields=None):
+    """Reads the parts of the event at ``offset`` of a buffer (like a memory mapped PML file). Unlike
+    ``read_event_parts`` there is no stream position to move, the parts are sliced straight out of the buffer.
+
+    :param buffer: a buffer of the whole PML file.
+    :param offset: the offset of the event in the buffer.
+    :param metadata: metadata of the PML file.
+    :param common_fields: the CommonEventStruct fields if they were already read.
+    :return: the same parts as ``read_event_parts``.
+    """
+    if common_fields is None:
+        common_fields = CommonEventStruct.unpack_from(buffer, offset)
+    stacktrace_depth, details_size, extra_details_offset = common_fields[9], common_fields[11], common_fields[12]
+
+    stacktrace_offset = offset + CommonEventStruct.size
+    details_offset = stacktrace_offset + stacktrace_depth * metadata.sizeof_pvoid
+    raw_stacktrace = buffer[stacktrace_offset:details_offset] if metadata.should_get_stacktrace else b""
+
+    # The details are parsed with a lot of small reads, which are faster on a BytesIO than on a BufferStream
+    details_stream = BytesIO(buffer[details_offset:details_offset + details_size])
+    extra_details_stream = None
+    if extra_details_offset > 0:
+        # The extra details structure surprisingly can be separated from the event structure
+        extra_details_offset += offset
+        extra_details_stream_size = unpack_from("<H", buffer, extra_details_offset)[0]
+        extra_details_offset += 2
+        extra_details_stream = BytesIO(buffer[extra_details_offset:extra_details_offset + extra_details_stream_size])
+    return common_fields, raw_stacktrace, details_stream, extra_details_stream
+
+
+def create_event(metadata, common_fields, raw_stacktrace, details_stream, extra_details_stream, compact=False):
+    """Creates an event from its parts, as returned by ``read_event_parts``.
+    If ``compact`` is True, the event is a ``CompactEvent`` with plain dictionary details.
+    """
+    process_idx, tid, event_class_val, operation_val, _, _, duration, date, result, _, _, _, _ = common_fields
+    process = metadata.process_idx(process_idx)
+    event_class, operation, details_handler = resolve_event_operation(event_class_val, operation_val)
+
+    details = CompactEventDetails() if compact else OrderedDict()
+    event = (CompactEvent if compact else Event)(
+        process=process, tid=tid, event_class=event_class, operation=operation, duration=duration, date_filetime=date,
+        result=result, stacktrace=read_stacktrace(raw_stacktrace, metadata), category='', path='', details=details)
+    if details_handler is not None:
+        details_handler(details_stream, metadata, event, extra_details_stream)
     return event
 
 
+def create_lazy_event(metadata, offset, common_fields, loader):
+    """Creates a lazy event from the CommonEventStruct fields only. The rest of the event is loaded by ``loader``
+    when it is accessed, see ``load_lazy_event``.
+    """
+    process_idx, tid, event_class_val, operation_val, _, _, duration, date, result, _, _, _, _ = common_fields
+    event_class, operation, _ = resolve_event_operation(event_class_val, operation_val)
+    operation_names = get_detailed_operation_names(event_class, operation)
+    return LazyEvent(offset, loader, process=metadata.process_idx(process_idx), tid=tid, event_class=event_class,
+                     operation=operation if operation_names is None else None, duration=duration, date_filetime=date,
+                     result=result, operation_names=operation_names)
+
+
+def load_lazy_event(metadata, event, should_load_details, common_fields, raw_stacktrace, details_stream,
+                    extra_details_stream):
+    """Sets the lazy attributes of an event from its parts, as returned by ``read_event_parts``.
+    """
+    if should_load_details:
+        _, event.operation, details_handler = resolve_event_operation(common_fields[2], common_fields[3])
+        event.category = ''
+        event.path = ''
+        event.details = OrderedDict()
+        if details_handler is not None:
+            details_handler(details_stream, metadata, event, extra_details_stream)
+    else:
+        event.stacktrace = read_stacktrace(raw_stacktrace, metadata)
+
+
+def _load_lazy_event_parts(metadata, parts, event, should_load_details):
+    """A loader of a lazy event from its parts that were already read, see ``load_lazy_event``.
+    """
+    load_lazy_event(metadata, event, should_load_details, *parts)
+
+
+def read_event(io, metadata):
+    """Reads the event that the stream points to.
+
+    :param io: the stream.
+    :param metadata: metadata of the PML file.
+    :return: Event object.
+    """
+    return create_event(metadata, *read_event_parts(io, metadata))
+
+
+PML_READER_BACKENDS = ("stream", "mmap", "pread")
+
+
 class PMLStreamReader(PMLStructReader):
-    def __init__(self, f, should_get_stacktrace=True, should_get_details=True):
-        self._stream = f
-        self._header = Header(self._stream)
-        self._read_pvoid = get_pvoid_reader(self.header.is_64bit)
-
-        self._stream.seek(self.header.events_offsets_array_offset)
-        self._events_offsets = EventOffsetsArray(
-            self._stream, self.header.process_table_offset - self.header.events_offsets_array_offset,
-            self.header.number_of_events)
-
-        self._stream.seek(self.header.strings_table_offset)
-        self._strings_table = StringsTable(self._stream)
-        self._stream.seek(self.header.process_table_offset)
-        self._process_table = ProcessTable(self._stream, read_pvoid=self._read_pvoid, strings_table=self._strings_table)
-        self._stream.seek(self.header.hosts_and_ports_tables_offset)
-
-        hostnames_and_ports_tables_stream = BytesIO(self._stream.read())  # this is the end of the file
-        self._hostnames_table = HostnamesTable(hostnames_and_ports_tables_stream)
-        self._ports_table = PortsTable(hostnames_and_ports_tables_stream)
-        self._metadata = PmlMetadata(self.__str_idx, self.__process_idx, self.__hostname_idx, self.__port_idx,
-                                     self._read_pvoid, get_pvoid_size(self.header.is_64bit),
-                                     should_get_stacktrace, should_get_details)
+    WINDOW_SIZE = 0x800000  # the size of the windows of the file that are read when iterating over the events
+
+    def __init__(self, f, should_get_stacktrace=True, should_get_details=True, backend="stream", lazy=False,
+                 where=None, filter_rules=None, intern_stacktraces=False, compact=False, index=None):
+        """
+        See ``ProcmonLogsReader`` for the parameters.
+
+        :param index: a ``PMLIndex`` of the file. The offsets of the events are taken from the index instead of the
+        file, the ``where`` filter is checked on the columns of the index, and ``scan_columns`` and ``index_at_time``
+        read the index instead of the events.
+        """
+        if lazy and compact:
+            raise ValueError("Events can't be both lazy and compact")
+        self._lazy = lazy
+        self._compact = compact
+        self._mmap = None
+        self._buffer = None
+        self._fd = None
+        if backend == "pread" and not hasattr(os, "pread"):
+            if PY2:
+                raise ValueError("The pread backend requires Python 3")
+            # os.pread is missing on Windows, where the mmap backend is also safe for reading from multiple threads
+            backend = "mmap"
+        if backend == "stream":
+            self._stream = f
+        elif backend == "mmap":
+            self._buffer = self.__map_file(f)
+            self._stream = BufferStream(self._buffer)
+        elif backend == "pread":
+            self._fd = f.fileno()
+            self._stream = f  # only used for reading the tables, the events are read with os.pread
+        else:
+            raise ValueError("Unknown PML reader backend \"{}\", expected one of {}".format(
+                backend, ", ".join(PML_READER_BACKENDS)))
+
+        try:
+            self._header = Header(self._stream)
+            self._read_pvoid = get_pvoid_reader(self.header.is_64bit)
+
+            self._index = index
+            if index is not None:
+                if index.number_of_events != self.header.number_of_events:
+                    raise PMLError("The index doesn't match the PML file")
+                self._events_offsets = index.events_offsets
+            else:
+                self._stream.seek(self.header.events_offsets_array_offset)
+                self._events_offsets = EventOffsetsArray.read(
+                    self._stream, self.header.process_table_offset - self.header.events_offsets_array_offset,
+                    self.header.number_of_events)
+
+            self._stream.seek(self.header.strings_table_offset)
+            # The strings and the processes are read on demand. With the stream backend they are read from the shared
+            # stream, otherwise from streams of their own.
+            tables_stream_at = self.__stream_at if self._fd is not None or self._buffer is not None else None
+            self._strings_table = StringsTable(self._stream, stream_at=tables_stream_at)
+            self._stream.seek(self.header.process_table_offset)
+            self._process_table = ProcessTable(
+                self._stream, get_pvoid_size(self.header.is_64bit), self._strings_table,
+                stream_at=tables_stream_at)
+            self._stream.seek(self.header.hosts_and_ports_tables_offset)
+
+            hostnames_and_ports_tables_stream = BytesIO(self._stream.read())  # this is the end of the file
+            self._hostnames_table = HostnamesTable(hostnames_and_ports_tables_stream)
+            self._ports_table = PortsTable(hostnames_and_ports_tables_stream)
+            self._metadata = PmlMetadata(self.__str_idx, self.__process_idx, self.__hostname_idx, self.__port_idx,
+                                         self._read_pvoid, get_pvoid_size(self.header.is_64bit),
+                                         should_get_stacktrace, should_get_details,
+                                         StacktraceTable(get_pvoid_size(self.header.is_64bit))
+                                         if intern_stacktraces else None)
+            self._where = compile_where(where, self._process_table)
+            self._where_fields = where
+            self._where_mask = None  # the where filter checked on all the columns of the index, on the first iteration
+            self._filter_rules = None
+            if filter_rules and self.number_of_events > 0:
+                first_event_date_filetime = self.__read_common_fields(self.events_offsets[0])[7]
+                self._filter_rules = compile_rules(filter_rules, first_event_date_filetime)
+        except BaseException:
+            # Release the memory mapping of a file that failed to parse, unless views of it are still alive, which
+            # release it when they are collected
+            try:
+                self.__release_buffer()
+            except BufferError:
+                pass
+            raise
+
+    def __map_file(self, f):
+        """Get a buffer of the whole file, so the file is parsed straight from memory without copying it.
+        """
+        if PY2:
+            raise ValueError("The mmap backend requires Python 3")
+        if hasattr(f, "getbuffer"):
+            return f.getbuffer()  # in-memory streams like BytesIO are already a buffer
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def close(self):
+        """Release the memory mapping of the file if there is one. The file object itself is not closed.
+        The processes that were already read keep working, their modules are loaded before the file is released.
+        """
+        if self._stream is not None:
+            self._process_table.load_modules()
+        self._stream = None
+        self._fd = None
+        self.__release_buffer()
+
+    def __release_buffer(self):
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
 
     def __str_idx(self, string_index):
         """Get the actual string from a string index
@@ -279,12 +657,264 @@ class PMLStreamReader(PMLStructReader):
     def events_offsets(self):
         return self._events_offsets
 
+    @property
+    def index(self):
+        """The ``PMLIndex`` of the file, or None if the reader doesn't use an index.
+        """
+        return self._index
+
+    @property
+    def process_table(self):
+        """The dictionary of process index to Process.
+        """
+        return self._process_table
+
+    @property
+    def stacktraces(self):
+        """The table of the interned stack traces, or None if the stack traces are not interned.
+        """
+        return self._metadata.stacktrace_table
+
     def processes(self):
         """Return a list of all the known processes in the log file
         """
         return list(self._process_table.values())
 
-    def get_event_at_offset(self, offset):
+    def share_processes(self, known_processes):
+        """Replace the processes of the log that are already known from another log of the same capture (like the
+        linked files of a big capture), so the same process is represented by the same object.
+
+        :param known_processes: a dictionary of (pid, parent_pid, start_time, image_path) to a Process, which is
+        updated with the new processes of this log.
+        """
+        for process_index, process in list(self._process_table.items()):
+            key = (process.pid, process.parent_pid, process.start_time, process.image_path)
+            known_process = known_processes.setdefault(key, process)
+            if known_process is not process:
+                if process._count_modules() > known_process._count_modules():
+                    known_process.modules = process.modules  # more modules were loaded since the previous log
+                known_process.end_time = known_process.end_time or process.end_time
+                self._process_table[process_index] = known_process
+
+    def _read_range(self, offset, size):
+        """Get ``size`` bytes of the file from ``offset`` as a numpy array of bytes.
+        """
+        if self._buffer is not None:
+            return numpy.frombuffer(self._buffer, dtype=numpy.uint8, count=size, offset=offset)
+        return numpy.frombuffer(self.__stream_at(offset).read(size), dtype=numpy.uint8)
+
+    def scan_columns(self, columns=None, chunk_size=0x10000):
+        """Read the common fields of all the events as numpy arrays, without creating Event objects or parsing the
+        stack traces and the details of the events.
+
+        :param columns: names of the columns to read, the names in ``CommonEventColumns`` or "pid" (which is
+        ``UNKNOWN_PID`` for events of processes that are not in the process table). Default is all.
+        :param chunk_size: number of events that are gathered together in one vectorized step.
+        :return: an ordered dictionary of column name to a numpy array with a value for every event. The columns of the
+        index of the reader are read-only views of the memory mapped index.
+        """
+        if numpy is None:
+            raise ImportError("scan_columns requires numpy")
+
+        available_columns = [name for name, _, _ in CommonEventColumns] + ["pid"]
+        columns = available_columns if columns is None else list(columns)
+        for column in columns:
+            if column not in available_columns:
+                raise ValueError("Unknown column \"{}\", expected one of {}".format(
+                    column, ", ".join(available_columns)))
+        if self._index is not None and all(column in self._index.columns or column == "pid" for column in columns):
+            return self._index.scan_columns(columns)
+
+        dtype = numpy.dtype({"names": [name for name, _, _ in CommonEventColumns],
+                             "formats": [column_type for _, column_type, _ in CommonEventColumns],
+                             "offsets": [offset for _, _, offset in CommonEventColumns],
+                             "itemsize": CommonEventStruct.size})
+        offsets = numpy.asarray(self.events_offsets.offsets, dtype=numpy.int64)
+        records = numpy.empty(len(offsets), dtype=dtype)
+        struct_range = numpy.arange(CommonEventStruct.size)
+        for start in range(0, len(offsets), chunk_size):
+            chunk_offsets = offsets[start:start + chunk_size]
+            first_offset = int(chunk_offsets.min())
+            data = self._read_range(first_offset, int(chunk_offsets.max()) + CommonEventStruct.size - first_offset)
+            indexes = (chunk_offsets - first_offset)[:, None] + struct_range
+            records[start:start + len(chunk_offsets)] = data[indexes].view(dtype).ravel()
+
+        result = OrderedDict()
+        for column in columns:
+            if column == "pid":
+                result[column] = get_pid_column(self._process_table, records["process_index"])
+            else:
+                result[column] = numpy.ascontiguousarray(records[column])
+        return result
+
+    def __stream_at(self, offset):
+        """Get a stream that points to ``offset``. With the mmap and pread backends every call gets a stream of its
+        own, so reading the events is safe from multiple threads.
+        """
+        if self._stream is None:
+            raise PMLError("The PML file of the reader was closed")
+        if self._fd is not None:
+            return PositionalStream(self._fd, offset)
+        if self._buffer is not None:
+            return BufferStream(self._buffer, offset)
         self._stream.seek(offset)
-        event = read_event(self._stream, self._metadata)
-        return event
+        return self._stream
+
+    def __read_event_parts(self, offset):
+        if self._buffer is not None:
+            return read_event_parts_from_buffer(self._buffer, offset, self._metadata)
+        return read_event_parts(self.__stream_at(offset), self._metadata)
+
+    def __read_common_fields(self, offset):
+        if self._buffer is not None:
+            return CommonEventStruct.unpack_from(self._buffer, offset)
+        return CommonEventStruct.unpack(self.__stream_at(offset).read(CommonEventStruct.size))
+
+    def __load_lazy_event(self, event, should_load_details):
+        load_lazy_event(self._metadata, event, should_load_details, *self.__read_event_parts(event._offset))
+    def get_event_at_offset(self, offset):
+        if self._lazy:
+            return create_lazy_event(self._metadata, offset, self.__read_common_fields(offset), self.__load_lazy_event)
+        return create_event(self._metadata, *self.__read_event_parts(offset), compact=self._compact)
+
+    def __iter_buffer(self, offsets):
+        buffer = self._buffer
+        for offset in offsets:
+            yield offset, CommonEventStruct.unpack_from(buffer, offset), buffer, offset
+
+    def __iter_windows(self, offsets):
+        """Read the events in big windows of the file instead of reading every event on its own, because the events
+        are almost always contiguous. For every offset, yield the CommonEventStruct fields of the event, and a window
+        that contains the whole event (with its extra details) with the offset of the event in it.
+        """
+        window_size = self.WINDOW_SIZE
+        window = b""
+        window_start = 0
+        sizeof_pvoid = self._metadata.sizeof_pvoid
+        for offset in offsets:
+            # the ends of the parts of the event, where the last ones are known only after the first ones are read
+            needed_end = offset + CommonEventStruct.size
+            common_fields = None
+            while True:
+                if offset < window_start or needed_end > window_start + len(window):
+                    window_end = window_start + len(window)
+                    # The next window starts at the event, and keeps the part of it that was already read
+                    tail = window[offset - window_start:] if window_start <= offset < window_end else b""
+                    window_start = offset
+                    window = tail + self.__stream_at(offset + len(tail)).read(
+                        max(window_size, needed_end - offset) - len(tail))
+                    if needed_end > window_start + len(window):
+                        raise PMLError("PML is corrupt, event at offset 0x{:x} is truncated".format(offset))
+                window_offset = offset - window_start
+                if common_fields is None:
+                    common_fields = CommonEventStruct.unpack_from(window, window_offset)
+                    stacktrace_depth, details_size, extra_details_offset = \
+                        common_fields[9], common_fields[11], common_fields[12]
+                    needed_end += stacktrace_depth * sizeof_pvoid + details_size
+                    if extra_details_offset > 0:
+                        # The extra details structure can be separated from the event structure, and starts with its
+                        # size
+                        needed_end = max(needed_end, offset + extra_details_offset + 2)
+                elif extra_details_offset > 0:
+                    extra_details_end = offset + extra_details_offset + 2 + \
+                        unpack_from("<H", window, window_offset + extra_details_offset)[0]
+                    if extra_details_end > needed_end:
+                        needed_end = extra_details_end
+                        continue
+                    break
+                else:
+                    break
+            yield offset, common_fields, window, window_offset
+
+    def iter_events(self, start=0, stop=None):
+        """Yield the events from index ``start`` to ``stop`` that match the ``where`` filter and the filter rules of
+        the reader. The ``where`` filter is checked on the CommonEventStruct fields, so the rest of the events that
+        don't match is never parsed. The filter rules are checked on a lazy event, so the details are parsed only if
+        the rules on the other columns pass.
+        """
+        offsets = self.events_offsets[start:stop]
+        metadata = self._metadata
+        where = self._where
+        if where is not None and self._index is not None:
+            # Only the events that match the filter are visited, without reading the rest of the events at all
+            if self._where_mask is None:
+                self._where_mask = where_mask(self._where_fields, self._process_table, self._index.columns)
+            mask = self._where_mask[start:stop]
+            offsets = EventOffsetsArray(offsets.offsets[mask], offsets.flags[mask])
+            where = None
+        filter_rules = self._filter_rules
+        events_parts = self.__iter_buffer(offsets) if self._buffer is not None else self.__iter_windows(offsets)
+        for offset, common_fields, buffer, buffer_offset in events_parts:
+            if where is not None and not where(common_fields):
+                continue
+            if filter_rules is None:
+                if self._lazy:
+                    yield create_lazy_event(metadata, offset, common_fields, self.__load_lazy_event)
+                else:
+                    yield create_event(metadata, *read_event_parts_from_buffer(buffer, buffer_offset, metadata,
+                                                                               common_fields), compact=self._compact)
+                continue
+
+            # The rules are checked on a lazy event that is loaded from the parts of the event in the buffer that was
+            # already read, instead of reading the event from the file again
+            parts = read_event_parts_from_buffer(buffer, buffer_offset, metadata, common_fields)
+            event = create_lazy_event(metadata, offset, common_fields, functools.partial(_load_lazy_event_parts,
+                                                                                         metadata, parts))
+            if not filter_rules(event):
+                continue
+            if self._lazy:
+                # The yielded event reads the rest of it from the file, so it doesn't keep the buffer alive
+                event._loader = self.__load_lazy_event
+                yield event
+            elif "details" in event.__dict__:
+                # The details were already parsed by the rules, so the event is built from the lazy event
+                details = CompactEventDetails(event.details) if self._compact else event.details
+                yield (CompactEvent if self._compact else Event)(
+                    process=event.process, tid=event.tid, event_class=event.event_class, operation=event.operation,
+                    duration=event.duration, date_filetime=event.date_filetime, result=event.result,
+                    stacktrace=read_stacktrace(parts[1], metadata), category=event.category, path=event.path,
+                    details=details)
+            else:
+                yield create_event(metadata, *parts, compact=self._compact)
+
+    def __iter__(self):
+        return self.iter_events()
+
+    def __read_date(self, index):
+        if self._index is not None:
+            return int(self._index.columns["date_filetime"][index])
+        offset = self.events_offsets[index]
+        if self._buffer is not None:
+            return unpack_from("<Q", self._buffer, offset + EVENT_DATE_OFFSET)[0]
+        return read_u64(self.__stream_at(offset + EVENT_DATE_OFFSET))
+
+    def index_at_time(self, filetime):
+        """Get the index of the first event that happened at ``filetime`` or after it, with a binary search that reads
+        only the dates of the probed events. The events are stored in capture order so their dates are nearly sorted,
+        and the result is exact up to the few events that are out of order.
+
+        :param filetime: a FILETIME value, or a datetime in UTC (like ``Event.date()``).
+        """
+        if isinstance(filetime, datetime.datetime):
+            filetime = datetime_to_filetime(filetime)
+        low, high = 0, len(self.events_offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__read_date(middle) < filetime:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def time_range(self, start, end):
+        """Yield the events that happened from ``start`` until ``end`` (not included), without reading the events
+        before them. Like iteration, the events are filtered by the filters of the reader.
+
+        :param start: a FILETIME value, or a datetime in UTC.
+        :param end: a FILETIME value, or a datetime in UTC.
+        """
+        start = datetime_to_filetime(start) if isinstance(start, datetime.datetime) else start
+        end = datetime_to_filetime(end) if isinstance(end, datetime.datetime) else end
+        for event in self.iter_events(self.index_at_time(start), self.index_at_time(end)):
+            if start <= event.date_filetime < end:
+                yield event
@@ -20,6 +20,10 @@ setuptools.setup(
         "six",
         "ipaddress;python_version<'3'",
     ],
+    extras_require={
+        "numpy": ["numpy"],
+        "parquet": ["pyarrow"],
+    },
     classifiers=[
         "Intended Audience :: Developers",
         "Intended Audience :: Education",
@@ -1,5 +1,4 @@
 import argparse
-import glob
 import io
 import timeit
 
@@ -10,19 +9,16 @@ if PY2:
 else:
     from csv import DictReader
 
-from itertools import chain
-from procmon_parser import ProcmonLogsReader
+from procmon_parser import ProcmonLogSetReader
+from procmon_parser.stream_helper import BufferStream, read_utf16, read_utf16_multisz
 
 
 def read_pml_logs(pml_path):
     """Reads a pml, and linked PML files if exist
     """
-    pml_readers = []
-    for logfile_path in [pml_path] + glob.glob("{0}-*.{1}".format(*pml_path.rsplit('.', 1))):
-        pml_readers.append(ProcmonLogsReader(open(logfile_path, "rb"), should_get_stacktrace=False))
-    pml_reader = chain(*pml_readers)
-    for _ in pml_reader:
-        pass
+    with ProcmonLogSetReader(pml_path, should_get_stacktrace=False) as pml_reader:
+        for _ in pml_reader:
+            pass
 
 
 def read_csv_logs(csv_path):
@@ -47,12 +43,73 @@ def benchmark(pml_path, csv_path):
     print(timeit.timeit("read_csv_logs(\"{}\")".format(csv_path).replace('\\', '\\\\'), setup=setup, number=5))
 
 
+def read_utf16_per_character(f, size=-1):
+    """The previous implementation of read_utf16, which reads and concatenates one character at a time
+    """
+    raw = b""
+    i = 0
+    while size == -1 or i < size:
+        wchar = f.read(2)
+        i += 2
+        if wchar == b"" or wchar == b"\x00\x00":
+            break
+        raw += wchar
+    if i < size:
+        f.seek(size - i, 1)
+    return raw.decode("UTF-16le", "replace")
+
+
+def read_utf16_multisz_per_character(f):
+    """The previous implementation of read_utf16_multisz (without a size)
+    """
+    multisz = []
+    current = b""
+    is_word_done = False
+    while True:
+        wchar = f.read(2)
+        if wchar == b"" or wchar == b"\x00\x00":
+            if is_word_done:
+                break
+            is_word_done = True
+            multisz.append(current.decode("UTF-16le", "replace"))
+            current = b""
+        else:
+            is_word_done = False
+            current += wchar
+    if current:
+        multisz.append(current.decode("UTF-16le", "replace"))
+    return multisz
+
+
+def benchmark_strings(number=200):
+    """Compare decoding UTF-16 strings of different lengths (like paths, command lines and environment blocks) from a
+    file-like stream and from a memory buffer (like the "mmap" backend)
+    """
+    for length in (64, 1024, 32768):
+        data = (u"C:\\Windows\\" * length)[:length].encode("UTF-16le") + b"\x00\x00"
+        multisz_data = (u"A=B\x00" * (length // 4)).encode("UTF-16le") + b"\x00\x00"
+        functions = [
+            ("per character", lambda: read_utf16_per_character(io.BytesIO(data))),
+            ("read_utf16", lambda: read_utf16(io.BytesIO(data))),
+            ("read_utf16 (sized)", lambda: read_utf16(io.BytesIO(data), len(data))),
+            ("read_utf16 (buffer)", lambda: read_utf16(BufferStream(data), len(data))),
+            ("multisz per character", lambda: read_utf16_multisz_per_character(io.BytesIO(multisz_data))),
+            ("read_utf16_multisz", lambda: read_utf16_multisz(io.BytesIO(multisz_data))),
+        ]
+        for name, function in functions:
+            print("{} characters, {}: {:.6f}".format(length, name, timeit.timeit(function, number=number) / number))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pml-path", type=str, help="Path to PML file")
     parser.add_argument("--csv-path", type=str, help="Path to CSV file converted from the PML")
+    parser.add_argument("--strings", action="store_true", help="Benchmark decoding UTF-16 strings")
     args = parser.parse_args()
-    benchmark(args.pml_path, args.csv_path)
+    if args.strings:
+        benchmark_strings()
+    if args.pml_path:
+        benchmark(args.pml_path, args.csv_path)
 
 
 if __name__ == "__main__":
@@ -34,6 +34,13 @@ def csv_logs_windows7_32bit():
     return decompress_resource("CompressedLogfileTests32bitUTCCSV")
 
 
+@pytest.fixture(scope='session')
+def pml_path_windows7_32bit(pml_logs_windows7_32bit, tmpdir_factory):
+    path = tmpdir_factory.mktemp("pml").join("LogfileTests32bit.PML")
+    path.write_binary(pml_logs_windows7_32bit)
+    return str(path)
+
+
 @pytest.fixture(scope='session')
 def pml_logs_windows10_64bit():
     return decompress_resource("CompressedLogfileTests64bitUTCPML")
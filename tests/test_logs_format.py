@@ -1,10 +1,33 @@
 
+import csv
+import json
+import mmap
+import operator
+import os
+import pickle
 import re
+import sqlite3
+from array import array
+from collections import Counter
+from io import BytesIO, StringIO
+from multiprocessing.pool import ThreadPool
+from struct import unpack_from
+
+import pytest
 from dateutil.parser import parse
 from datetime import timedelta
 from six import PY2
 from six.moves import zip_longest
-from procmon_parser.consts import Column, ColumnToOriginalName, RegistryOperation, NetworkOperation, ProcessOperation
+
+from procmon_parser import ProcmonLogsReader, ProcmonLogSetReader, Rule, PMLError
+from procmon_parser.consts import Column, ColumnToOriginalName, RegistryOperation, NetworkOperation, ProcessOperation, \
+    EventClass, RuleAction, RuleRelation
+from procmon_parser.filters import RulesFilter
+from procmon_parser.export import fold_stacks, write_folded_stacks, to_parquet, to_sqlite, write_csv, CSV_COLUMNS
+from procmon_parser.index import PMLIndex, get_index_path, load_index, build_index
+from procmon_parser.stream_helper import BufferStream, read_utf16, read_utf16_multisz, decode_utf16, decode_utf16_multisz
+from procmon_parser import consts, stream_logs_format, index as index_module
+from procmon_parser.stream_logs_format import PMLStreamReader, Header, StringsTable, EventOffsetsArray
 
 
 SUPPORTED_COLUMNS = [
@@ -191,6 +214,585 @@ def test_pml_equals_csv_specific_events(specific_events_logs_readers):
     check_pml_equals_csv(specific_events_logs_readers[0], specific_events_logs_readers[1])
 
 
+@pytest.mark.skipif(PY2, reason="The mmap backend requires Python 3")
+def test_pml_equals_csv_64bit_mmap(csv_reader_windows10_64bit, pml_logs_windows10_64bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), backend="mmap")
+    check_pml_equals_csv(csv_reader_windows10_64bit, pml_reader)
+
+
+@pytest.mark.skipif(PY2, reason="The mmap backend requires Python 3")
+def test_mmap_backend_from_path(pml_path_windows7_32bit, pml_reader_windows7_32bit):
+    with ProcmonLogsReader(pml_path_windows7_32bit, backend="mmap") as pml_reader:
+        assert len(pml_reader) == len(pml_reader_windows7_32bit)
+        assert pml_reader.processes() == pml_reader_windows7_32bit.processes()
+        assert pml_reader[-100:] == pml_reader_windows7_32bit[-100:]
+
+
+@pytest.mark.skipif(PY2, reason="The mmap backend requires Python 3")
+def test_mmap_backend_corrupt_file(pml_logs_windows7_32bit, tmpdir, monkeypatch):
+    mappings = []
+
+    class RecordingMmap(mmap.mmap):
+        def __init__(self, *args, **kwargs):
+            mappings.append(self)
+    monkeypatch.setattr(mmap, "mmap", RecordingMmap)
+    tmpdir.join("Log.PML").write_binary(pml_logs_windows7_32bit[:0x1000])
+    with pytest.raises(PMLError):
+        ProcmonLogsReader(str(tmpdir.join("Log.PML")), backend="mmap")
+    assert len(mappings) == 1 and mappings[0].closed
+
+
+@pytest.mark.skipif(not PY2, reason="The mmap backend requires Python 3")
+def test_mmap_backend_python2(pml_path_windows7_32bit):
+    with pytest.raises(ValueError):
+        ProcmonLogsReader(pml_path_windows7_32bit, backend="mmap")
+
+
+@pytest.mark.skipif(PY2, reason="The mmap and pread backends require Python 3")
+def test_pread_backend_fallback(pml_path_windows7_32bit, pml_reader_windows7_32bit, monkeypatch):
+    monkeypatch.delattr(os, "pread")
+    with ProcmonLogsReader(pml_path_windows7_32bit, backend="pread") as pml_reader:
+        assert pml_reader._struct_readear._buffer is not None
+        assert pml_reader[-100:] == pml_reader_windows7_32bit[-100:]
+
+
+def test_pml_equals_csv_32bit_lazy(csv_reader_windows7_32bit, pml_logs_windows7_32bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), lazy=True)
+    check_pml_equals_csv(csv_reader_windows7_32bit, pml_reader)
+
+
+def test_pml_equals_csv_32bit_compact(csv_reader_windows7_32bit, pml_logs_windows7_32bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), compact=True)
+    check_pml_equals_csv(csv_reader_windows7_32bit, pml_reader)
+
+
+def test_compact_event(pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), compact=True)
+    compact_events = pml_reader[:2000]
+    events = pml_reader_windows10_64bit[:2000]
+    assert all(not hasattr(e, '__dict__') for e in compact_events)
+    assert compact_events == events and events == compact_events
+    assert compact_events[0] != events[1] and events[1] != compact_events[0]
+    assert pickle.loads(pickle.dumps(compact_events[-1])) == compact_events[-1]
+    with pytest.raises(ValueError):
+        ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), compact=True, lazy=True)
+
+
+def test_lazy_event(pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), lazy=True)
+    lazy_events = pml_reader[:2000]
+    assert all('details' not in e.__dict__ and 'stacktrace' not in e.__dict__ for e in lazy_events)
+    event = next(e for e in lazy_events if e.event_class == EventClass.File_System and e._operation_names is None)
+    assert event.process.pid and event.operation and 'details' not in event.__dict__
+    event = next(e for e in lazy_events if e.event_class == EventClass.File_System and e._operation_names is not None)
+    assert event.process.pid and 'operation' not in event.__dict__
+    assert event.stacktrace and 'details' not in event.__dict__
+    assert event.path and 'details' in event.__dict__
+    assert event.operation in event._operation_names
+    assert lazy_events == pml_reader_windows10_64bit[:2000]
+    assert pickle.loads(pickle.dumps(lazy_events[-1])) == lazy_events[-1]
+
+
+def test_events_hash(pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    events = pml_reader_windows10_64bit[:2000]
+    compact_events = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), compact=True)[:2000]
+    lazy_events = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), lazy=True)[:2000]
+    for event, compact_event, lazy_event in zip(events, compact_events, lazy_events):
+        assert hash(event) == hash(compact_event) == hash(lazy_event)
+    assert len(set(events)) == len(set(compact_events)) == len(set(lazy_events))
+    assert {events[0]: 0}[compact_events[0]] == 0
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_where_filter(lazy, pml_logs_windows7_32bit, pml_reader_windows7_32bit):
+    all_events = list(pml_reader_windows7_32bit)
+    pids = {all_events[0].process.pid, all_events[-1].process.pid}
+    where = {"event_class": EventClass.Registry, "pid": pids, "result": 0}
+    expected_events = [e for e in all_events if e.event_class == EventClass.Registry and e.process.pid in pids and
+                       e.result == 0]
+    assert expected_events
+    assert list(ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), lazy=lazy, where=where)) == expected_events
+
+    where = {"operation": [RegistryOperation.RegOpenKey, "Thread_Create"]}
+    expected_events = [e for e in all_events if e.operation in ("RegOpenKey", "Thread_Create")]
+    assert expected_events
+    assert list(ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), lazy=lazy, where=where)) == expected_events
+
+    with pytest.raises(ValueError):
+        ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), where={"path": "C:\\"})
+
+
+def rule_matches(rule, value):
+    value, rule_value = value.lower(), rule.value.lower()
+    return {
+        RuleRelation.IS: value == rule_value,
+        RuleRelation.IS_NOT: value != rule_value,
+        RuleRelation.BEGINS_WITH: value.startswith(rule_value),
+        RuleRelation.ENDS_WITH: value.endswith(rule_value),
+        RuleRelation.CONTAINS: rule_value in value,
+        RuleRelation.EXCLUDES: rule_value not in value,
+    }[rule.relation]
+
+
+def event_passes_rules(rules, event, first_event_date_filetime):
+    matches = [(rule, rule_matches(rule, event.get_compatible_csv_column(rule.column, first_event_date_filetime)))
+               for rule in rules]
+    if any(match for rule, match in matches if rule.action == RuleAction.EXCLUDE):
+        return False
+    include_columns = set(rule.column for rule in rules if rule.action == RuleAction.INCLUDE)
+    return all(any(match for rule, match in matches if rule.column == column and rule.action == RuleAction.INCLUDE)
+               for column in include_columns)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_filter_rules(lazy, pml_logs_windows7_32bit, pml_reader_windows7_32bit):
+    rules = [Rule('Process_Name', 'is', 'explorer.exe', 'include'), Rule('Process_Name', 'is', 'chrome.exe', 'include'),
+             Rule('Operation', 'begins_with', 'RegQuery', 'exclude'), Rule('Operation', 'is', 'RegCloseKey', 'exclude'),
+             Rule('Path', 'contains', 'Windows', 'include'), Rule('Path', 'ends_with', '.dll', 'include'),
+             Rule('Result', 'is_not', 'NAME NOT FOUND', 'include'), Rule('Event_Class', 'is', 'Network', 'exclude')]
+    all_events = list(pml_reader_windows7_32bit)
+    expected_events = [e for e in all_events if event_passes_rules(rules, e, all_events[0].date_filetime)]
+    assert 0 < len(expected_events) < len(all_events)
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), lazy=lazy, filter_rules=rules)
+    assert list(pml_reader) == expected_events
+
+
+def test_operation_rules_without_details(pml_logs_windows7_32bit, pml_reader_windows7_32bit):
+    rules = [Rule('Operation', 'is', 'QueryStandardInformationFile', 'include'),
+             Rule('Operation', 'is', 'CreateFile', 'include'), Rule('Operation', 'begins_with', 'TCP', 'include')]
+    all_events = list(pml_reader_windows7_32bit)
+    expected_events = [e for e in all_events if event_passes_rules(rules, e, all_events[0].date_filetime)]
+    assert 0 < len(expected_events) < len(all_events)
+    lazy_events = list(ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), lazy=True))
+    rules_filter = RulesFilter(rules, all_events[0].date_filetime)
+    filtered_events = [e for e in lazy_events if rules_filter(e)]
+    # Only the events whose operation depends on their details were loaded to check the rules
+    loaded_events = [e for e in lazy_events if 'details' in e.__dict__]
+    assert loaded_events and all(e._operation_names is not None for e in loaded_events)
+    assert len(loaded_events) < sum(1 for e in lazy_events if e._operation_names is not None)
+    assert filtered_events == expected_events
+
+
+def test_time_range(pml_logs_windows7_32bit, pml_reader_windows7_32bit):
+    all_events = list(pml_reader_windows7_32bit)
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit))
+    start, end = all_events[1000].date_filetime, all_events[5000].date_filetime
+    expected_events = [e for e in all_events if start <= e.date_filetime < end]
+    assert list(pml_reader.time_range(start, end)) == expected_events
+    assert pml_reader.index_at_time(start) == all_events.index(expected_events[0])
+
+    start_date = all_events[1000].date().replace(microsecond=0)
+    end_date = start_date + timedelta(seconds=2)
+    expected_events = [e for e in all_events if start_date <= e.date() < end_date]
+    assert expected_events
+    assert list(pml_reader.time_range(start_date, end_date)) == expected_events
+    assert pml_reader.index_at_time(0) == 0
+    assert pml_reader.index_at_time(all_events[-1].date_filetime + 1) == len(all_events)
+
+
+def test_log_set_reader(pml_logs_windows7_32bit, pml_reader_windows7_32bit, tmpdir):
+    for filename in ["Log.PML", "Log-1.PML", "Log-2.PML", "Log-2.PML.bak", "Other-3.PML"]:
+        tmpdir.join(filename).write_binary(pml_logs_windows7_32bit)
+    events = pml_reader_windows7_32bit[:3000]
+    number_of_events = len(pml_reader_windows7_32bit)
+
+    with ProcmonLogSetReader(str(tmpdir.join("Log.PML")), max_open_files=1) as pml_reader:
+        assert [os.path.basename(path) for path in pml_reader.paths] == ["Log.PML", "Log-1.PML", "Log-2.PML"]
+        assert len(pml_reader) == 3 * number_of_events
+        assert pml_reader[number_of_events + 5] == events[5]
+        assert pml_reader[2 * number_of_events - 1] == pml_reader_windows7_32bit[-1]
+        assert pml_reader[-1] == pml_reader_windows7_32bit[-1]
+        assert pml_reader[number_of_events - 2:number_of_events + 2] == \
+            pml_reader_windows7_32bit[-2:] + pml_reader_windows7_32bit[:2]
+        assert pml_reader[2 * number_of_events + 10].process is pml_reader[10].process
+        assert len(pml_reader.processes()) == len(pml_reader_windows7_32bit.processes())
+
+    # The file that is being iterated is kept open while other files are read
+    with ProcmonLogSetReader(str(tmpdir.join("Log.PML")), max_open_files=1) as pml_reader:
+        iterated_events = []
+        for i, event in enumerate(pml_reader.iter_events()):
+            iterated_events.append(event)
+            if i % 1000 == 0:
+                assert pml_reader[2 * number_of_events + i] == pml_reader_windows7_32bit[i]
+            if i == 3000:
+                assert len(pml_reader._readers) == 2
+                break
+        assert iterated_events == pml_reader_windows7_32bit[:3001]
+        # The file is closed when its iteration ends
+        assert len(pml_reader._readers) == 1
+
+    # A lazy event whose file was closed can't be loaded anymore
+    with ProcmonLogSetReader(str(tmpdir.join("Log.PML")), max_open_files=1, lazy=True) as pml_reader:
+        event = pml_reader[5]
+        assert pml_reader[number_of_events + 5].path == events[5].path
+        with pytest.raises(PMLError):
+            event.details
+
+    pid = Counter(e.process.pid for e in events).most_common()[-1][0]
+    with ProcmonLogSetReader(str(tmpdir.join("Log.PML")), where={"pid": pid}) as pml_reader:
+        expected_events = list(ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), where={"pid": pid}))
+        assert list(pml_reader) == expected_events * 3
+
+
+def get_event_pid_counter(event):
+    return Counter({event.process.pid: 1})
+
+
+def get_none(event):
+    return None
+
+
+def keep_first(first, second):
+    return first
+
+
+def test_parallel_iter(pml_path_windows7_32bit, pml_reader_windows7_32bit):
+    events = list(pml_reader_windows7_32bit)
+    pml_reader = ProcmonLogsReader(pml_path_windows7_32bit)
+    assert list(pml_reader.parallel_iter(workers=2, chunk_size=5000)) == events
+    summaries = list(pml_reader.parallel_iter(workers=2, chunk_size=5000, compact=True))
+    assert [s.path for s in summaries] == [e.path for e in events]
+    pid_counter = pml_reader.parallel_reduce(get_event_pid_counter, operator.add, workers=2, chunk_size=5000)
+    assert pid_counter == Counter(e.process.pid for e in events)
+    assert pml_reader.parallel_reduce(get_none, keep_first, workers=2, chunk_size=5000) is None
+    pml_reader = ProcmonLogsReader(pml_path_windows7_32bit, where={"pid": -1})
+    assert pml_reader.parallel_reduce(get_event_pid_counter, operator.add, workers=2, initial=Counter()) == Counter()
+    with pytest.raises(ValueError):
+        pml_reader.parallel_reduce(get_event_pid_counter, operator.add, workers=2)
+
+
+@pytest.mark.skipif(PY2, reason="The mmap and pread backends require Python 3")
+@pytest.mark.parametrize("backend", ["mmap", "pread"])
+def test_concurrent_random_access(backend, pml_path_windows7_32bit, pml_reader_windows7_32bit):
+    indexes = list(range(0, len(pml_reader_windows7_32bit), 11))
+    with ProcmonLogsReader(pml_path_windows7_32bit, backend=backend, intern_stacktraces=True) as pml_reader:
+        pool = ThreadPool(8)
+        try:
+            events = pool.map(lambda i: pml_reader[i], indexes)
+        finally:
+            pool.close()
+        stacktraces = pml_reader.stacktraces
+        assert len(set(stacktraces)) == len(stacktraces)
+        assert all(stacktraces[stacktraces.get_id(e.stacktrace)] is e.stacktrace for e in events)
+    with ProcmonLogsReader(pml_path_windows7_32bit, intern_stacktraces=True) as expected_reader:
+        assert events == [expected_reader[i] for i in indexes]
+
+
+@pytest.mark.parametrize("window_size", [0x100, 0x1000, 0x10000])
+def test_iteration_windows(window_size, pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    pml_reader = PMLStreamReader(BytesIO(pml_logs_windows10_64bit))
+    pml_reader.WINDOW_SIZE = window_size
+    assert list(pml_reader.iter_events(100, 3000)) == pml_reader_windows10_64bit[100:3000]
+
+
+class CountingStream(BytesIO):
+    bytes_read = 0
+    reads = 0
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        self.reads += 1
+        return data
+
+
+@pytest.mark.parametrize("window_size", [0x1000, 0x10000, PMLStreamReader.WINDOW_SIZE])
+def test_iteration_windows_read_once(window_size, pml_logs_windows10_64bit):
+    stream = CountingStream(pml_logs_windows10_64bit)
+    pml_reader = PMLStreamReader(stream)
+    pml_reader.WINDOW_SIZE = window_size
+    stream.bytes_read = 0
+    assert sum(1 for _ in pml_reader.iter_events()) == pml_reader.number_of_events
+    header = pml_reader.header
+    events_size = header.events_offsets_array_offset - header.events_offset
+    # Every byte of the events is read once. The last window can go a bit after them, and the strings and the
+    # processes of the events are read on demand.
+    assert events_size <= stream.bytes_read <= events_size * 1.01 + window_size
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_filter_rules_read_once(lazy, pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    # The default filter rules of Procmon, which need the details of the events
+    rules = [Rule('Process_Name', 'is', 'Procmon.exe', 'exclude'), Rule('Path', 'ends_with', 'pagefile.sys', 'exclude'),
+             Rule('Path', 'contains', '$Extend', 'exclude'), Rule('Event_Class', 'is', 'Profiling', 'exclude')]
+    stream = CountingStream(pml_logs_windows10_64bit)
+    pml_reader = PMLStreamReader(stream, filter_rules=rules, lazy=lazy)
+    stream.bytes_read = stream.reads = 0
+    events = list(pml_reader.iter_events(0, 20000))
+    header = pml_reader.header
+    events_size = header.events_offsets_array_offset - header.events_offset
+    # The rules are checked on the windows of the file that are already read, not by reading every event again. The
+    # other reads are of the strings and the processes of the events, which are read on demand.
+    assert stream.reads < 20000 // 50 and stream.bytes_read <= events_size * 1.01 + pml_reader.WINDOW_SIZE
+    expected_events = [e for e in pml_reader_windows10_64bit[:20000]
+                       if event_passes_rules(rules, e, pml_reader_windows10_64bit[0].date_filetime)]
+    assert events == expected_events
+
+
+def test_interned_stacktraces(pml_logs_windows10_64bit, pml_reader_windows10_64bit):
+    events = pml_reader_windows10_64bit[:3000]
+    assert all(isinstance(e.stacktrace, array) for e in events)
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), intern_stacktraces=True)
+    interned_events = pml_reader[:3000]
+    assert [e.stacktrace for e in interned_events] == [tuple(e.stacktrace) for e in events]
+    assert 0 < len(pml_reader.stacktraces) < len(set(id(e.stacktrace) for e in events))
+    for event in interned_events:
+        assert pml_reader.stacktraces[pml_reader.stacktraces.get_id(event.stacktrace)] is event.stacktrace
+
+
+def test_symbolize_stacktrace(pml_reader_windows10_64bit):
+    def symbolize_frame(process, address):
+        for module in process.modules:
+            if module.base_address <= address < module.base_address + module.size:
+                return "{}+0x{:x}".format(module.path.split("\\")[-1], address - module.base_address)
+        return "0x{:x}".format(address)
+
+    for event in pml_reader_windows10_64bit[:500]:
+        assert event.process.symbolize(event.stacktrace) == [symbolize_frame(event.process, address)
+                                                             for address in event.stacktrace]
+    process = event.process
+    module = process.modules[-1]
+    assert process.module_for_address(module.base_address + module.size - 1) is module
+    assert pickle.loads(pickle.dumps(process)) == process
+    assert process.module_for_address(0) is None
+
+
+def test_folded_stacks(pml_logs_windows10_64bit):
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932})
+    events = list(pml_reader)
+    assert events
+    system_process = next(p for p in pml_reader.processes() if p.pid == 4)
+    expected_counts = Counter()
+    expected_durations = Counter()
+    for event in events:
+        if not event.stacktrace:
+            continue
+        frames = event.process.symbolize(event.stacktrace, fallback=system_process)
+        folded_stack = ";".join([event.process.process_name] + frames[::-1])
+        expected_counts[folded_stack] += 1
+        expected_durations[folded_stack] += event.duration
+
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932})
+    assert fold_stacks(pml_reader, "count") == dict(expected_counts)
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932}, intern_stacktraces=True)
+    assert fold_stacks(pml_reader, "duration") == dict(expected_durations)
+
+    output = StringIO()
+    write_folded_stacks(ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932}), output)
+    lines = output.getvalue().splitlines()
+    assert lines == sorted("{} {}".format(stack, count) for stack, count in expected_counts.items())
+    assert lines[0].startswith("dwm.exe;ntdll.dll+")
+
+
+def test_to_parquet(pml_logs_windows10_64bit, tmpdir):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    events = list(ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932}))
+    path = str(tmpdir.join("events.parquet"))
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932})
+    assert to_parquet(pml_reader, path, row_group_size=1000) == len(events)
+    assert pyarrow.parquet.ParquetFile(path).num_row_groups == (len(events) + 999) // 1000
+
+    table = pyarrow.parquet.read_table(path)
+    assert "details" not in table.column_names
+    assert str(table.schema.field("path").type) == "dictionary<values=string, indices=int32, ordered=0>"
+    rows = table.to_pylist()
+    assert [(r["pid"], r["tid"], r["operation"], r["date_filetime"], r["duration"], r["result"], r["path"])
+            for r in rows] == \
+        [(e.process.pid, e.tid, e.operation, e.date_filetime, e.duration, e.result, e.path) for e in events]
+    assert rows[0]["process_name"] == events[0].process.process_name
+    assert rows[0]["event_class"] == events[0].event_class.name
+
+    pml_reader = ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit), where={"pid": 932})
+    to_parquet(pml_reader, path, columns=["operation", "details"])
+    rows = pyarrow.parquet.read_table(path).to_pylist()
+    assert [dict(r["details"]) for r in rows] == [{k: str(v) for k, v in e.details.items()} for e in events]
+
+    with pytest.raises(ValueError):
+        to_parquet(pml_reader, path, columns=["color"])
+
+
+@pytest.mark.parametrize("worker", [False, True])
+def test_to_sqlite(pml_path_windows7_32bit, pml_reader_windows7_32bit, tmpdir, worker):
+    events = list(pml_reader_windows7_32bit)
+    path = str(tmpdir.join("events.db"))
+    assert to_sqlite(ProcmonLogsReader(pml_path_windows7_32bit), path, batch_size=5000, worker=worker) == len(events)
+
+    connection = sqlite3.connect(path)
+    rows = connection.execute("SELECT process_name, pid, tid, event_class, operation, date_filetime, duration, "
+                              "result, category, path FROM events_view ORDER BY id").fetchall()
+    assert rows == [(e.process.process_name, e.process.pid, e.tid, e.event_class.name, e.operation, e.date_filetime,
+                     e.duration, e.result, e.category, e.path) for e in events]
+
+    def get_stacktrace(event_id):
+        return [address & 0xFFFFFFFFFFFFFFFF for address, in connection.execute(
+            "SELECT address FROM stack_frames JOIN events ON events.stacktrace_id = stack_frames.stacktrace_id "
+            "WHERE events.id = ? ORDER BY frame_index", (event_id,))]
+    assert get_stacktrace(1) == list(events[0].stacktrace)
+    assert get_stacktrace(len(events)) == list(events[-1].stacktrace)
+
+    process = events[0].process
+    modules = connection.execute("SELECT path, base_address, size FROM modules JOIN processes "
+                                 "ON processes.id = modules.process_id WHERE processes.pid = ?", (process.pid,))
+    assert sorted(modules) == sorted((m.path, m.base_address, m.size) for m in process.modules)
+    assert connection.execute("SELECT name FROM sqlite_master WHERE name = 'events_path_id'").fetchone()
+    connection.close()
+
+    # An existing database is replaced only when asked to
+    with pytest.raises(ValueError):
+        to_sqlite(ProcmonLogsReader(pml_path_windows7_32bit), path)
+    pml_reader = ProcmonLogsReader(pml_path_windows7_32bit, where={"pid": process.pid})
+    number_of_events = to_sqlite(pml_reader, path, batch_size=5000, worker=worker, overwrite=True)
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT COUNT(*) FROM events").fetchone()[0] == number_of_events
+    assert connection.execute("SELECT DISTINCT pid FROM events_view").fetchall() == [(process.pid,)]
+    connection.close()
+
+
+def test_write_csv(pml_reader_windows7_32bit, pml_logs_windows7_32bit):
+    events = list(pml_reader_windows7_32bit)
+    first_event_date_filetime = events[0].date_filetime
+    for columns in [CSV_COLUMNS, [Column.PID, Column.USER, Column.OPERATION, Column.RESULT, Column.DURATION]]:
+        output = BytesIO() if PY2 else StringIO()
+        assert write_csv(ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit)), output, columns, batch_size=1000) == \
+            len(events)
+        output.seek(0)
+        rows = list(csv.reader(output))
+        if PY2:
+            rows = [[value.decode("utf-8") for value in row] for row in rows]
+        names = [ColumnToOriginalName[column] for column in columns]
+        assert rows[0] == names
+        assert len(rows) == len(events) + 1
+        for i in [0, 1, 1000, len(events) - 1]:
+            csv_info = events[i].get_compatible_csv_info(first_event_date_filetime)
+            assert rows[i + 1] == [csv_info[name] for name in names]
+
+    with pytest.raises(ValueError):
+        write_csv(pml_reader_windows7_32bit, StringIO(), [Column.PROCESS_NAME, Column.NONE])
+
+
+def test_memoized_formatters(pml_logs_windows10_64bit, monkeypatch):
+    consts.clear_formatters_caches()
+    events = list(ProcmonLogsReader(BytesIO(pml_logs_windows10_64bit)))
+    cache_info = consts.get_formatters_cache_info()
+    assert cache_info["get_registry_access_mask_string"].hits > cache_info["get_registry_access_mask_string"].misses
+    assert all(info.currsize == info.misses for info in cache_info.values())
+    desired_accesses = set(e.details["Desired Access"] for e in events if e.operation == "RegOpenKey")
+    assert cache_info["get_registry_access_mask_string"].currsize >= len(desired_accesses)
+
+    consts.clear_formatters_caches()
+    consts.warm_formatters_caches({"get_error_message": [0, 0xC0000034], "get_ioctl_name": [0x90028]})
+    assert consts.get_error_message(0) == "SUCCESS"
+    assert consts.get_error_message(5) == "0x5"
+    assert consts.get_ioctl_name.cache_info() == consts.FormatterCacheInfo(0, 0, consts.FORMATTER_CACHE_SIZE, 1)
+    assert consts.get_error_message.cache_info() == consts.FormatterCacheInfo(1, 1, consts.FORMATTER_CACHE_SIZE, 3)
+
+    monkeypatch.setattr(consts, "FORMATTER_CACHE_SIZE", 3)
+    assert consts.get_error_message(6) == "0x6"  # formatted but not cached, the cache is full
+    assert consts.get_error_message.cache_info().currsize == 3
+    consts.clear_formatters_caches()
+
+
+def test_unknown_backend(pml_logs_windows7_32bit):
+    with pytest.raises(ValueError):
+        ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), backend="floppy")
+
+
+def test_scan_columns(pml_reader_windows7_32bit):
+    pytest.importorskip("numpy")
+    columns = pml_reader_windows7_32bit.scan_columns()
+    assert all(len(column) == len(pml_reader_windows7_32bit) for column in columns.values())
+    for i in [0, 1, 1000, len(pml_reader_windows7_32bit) - 1]:
+        event = pml_reader_windows7_32bit[i]
+        assert columns["pid"][i] == event.process.pid
+        assert columns["tid"][i] == event.tid
+        assert columns["event_class"][i] == event.event_class
+        assert columns["date_filetime"][i] == event.date_filetime
+        assert columns["duration"][i] == event.duration
+        assert columns["result"][i] == event.result
+        assert columns["stacktrace_depth"][i] == len(event.stacktrace)
+
+    assert list(pml_reader_windows7_32bit.scan_columns(["pid", "tid"])) == ["pid", "tid"]
+
+    # The events of a process index that is not in the process table don't get the pid of another process
+    process_table = pml_reader_windows7_32bit._struct_readear.process_table
+    last_process_index = max(process_table)
+    process_indexes = columns["process_index"].copy()
+    process_indexes[:2] = [last_process_index, last_process_index + 1]
+    pids = stream_logs_format.get_pid_column(process_table, process_indexes)
+    assert list(pids[:2]) == [process_table[last_process_index].pid, stream_logs_format.UNKNOWN_PID]
+    assert (pids[2:] == columns["pid"][2:]).all()
+    with pytest.raises(ValueError):
+        pml_reader_windows7_32bit.scan_columns(["color"])
+
+
+def test_sidecar_index(pml_logs_windows7_32bit, pml_reader_windows7_32bit, tmpdir, monkeypatch):
+    pytest.importorskip("numpy")
+    pml_path = str(tmpdir.join("Log.PML"))
+    tmpdir.join("Log.PML").write_binary(pml_logs_windows7_32bit)
+    assert get_index_path(pml_path) == str(tmpdir.join("Log.pmlidx"))
+
+    with ProcmonLogsReader(pml_path, index=True) as pml_reader:
+        assert os.path.exists(get_index_path(pml_path))
+        assert len(pml_reader) == len(pml_reader_windows7_32bit)
+        assert pml_reader[1000] == pml_reader_windows7_32bit[1000]
+        expected_columns = pml_reader_windows7_32bit.scan_columns()
+        columns = pml_reader.scan_columns(["pid", "tid", "operation", "date_filetime", "result"])
+        assert all((columns[name] == expected_columns[name]).all() for name in columns)
+        date = pml_reader_windows7_32bit[5000].date_filetime
+        assert pml_reader.index_at_time(date) == pml_reader_windows7_32bit.index_at_time(date)
+        assert [(p.pid, p.process_name, p.command_line, p.start_time) for p in pml_reader.index.processes.values()] == \
+            [(p.pid, p.process_name, p.command_line, p.start_time) for p in pml_reader_windows7_32bit.processes()]
+
+    pid = Counter(e.process.pid for e in pml_reader_windows7_32bit).most_common()[-1][0]
+    for where in [{"pid": pid}, {"event_class": EventClass.Registry, "operation": "RegOpenKey", "result": 0}]:
+        expected_reader = ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), where=where)
+        with ProcmonLogsReader(pml_path, where=where, index=True) as pml_reader:
+            assert list(pml_reader) == list(expected_reader)
+            assert list(pml_reader._struct_readear.iter_events(1000, 20000)) == \
+                list(expected_reader._struct_readear.iter_events(1000, 20000))
+
+    # An index that is up to date is reused, otherwise it is built again
+    index = load_index(pml_path, build=False)
+    assert isinstance(index, PMLIndex)
+    os.utime(pml_path, (0, 0))
+    assert load_index(pml_path, build=False) is None
+    assert load_index(pml_path).is_valid(pml_path)
+    tmpdir.join("Log.pmlidx").write_binary(tmpdir.join("Log.pmlidx").read_binary()[:-1])
+    assert load_index(pml_path, build=False) is None
+    assert load_index(pml_path).is_valid(pml_path)
+
+    # A sidecar whose description misses a key is stale too
+    index_data = tmpdir.join("Log.pmlidx").read_binary()
+    description_size = unpack_from("<8sII", index_data)[2]
+    description = json.loads(index_data[16:16 + description_size].decode("utf-8"))
+    del description["processes"]
+    encoded_description = json.dumps(description).encode("utf-8").ljust(description_size)
+    tmpdir.join("Log.pmlidx").write_binary(index_data[:16] + encoded_description + index_data[16 + description_size:])
+    assert load_index(pml_path, build=False) is None
+    assert load_index(pml_path).is_valid(pml_path)
+
+    # An interrupted build leaves the previous index and no temporary file
+    def interrupt(source, destination):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(index_module, "_replace", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        build_index(pml_path)
+    assert sorted(os.listdir(str(tmpdir))) == ["Log.PML", "Log.pmlidx"]
+    assert load_index(pml_path, build=False) is not None
+
+    with pytest.raises(ValueError):
+        ProcmonLogsReader(BytesIO(pml_logs_windows7_32bit), index=True)
+
+
+def test_sidecar_index_without_numpy(pml_path_windows7_32bit, monkeypatch):
+    monkeypatch.setattr(index_module, "numpy", None)
+    for open_index in [load_index, build_index, lambda path: ProcmonLogsReader(path, index=True)]:
+        with pytest.raises(ImportError, match="numpy"):
+            open_index(pml_path_windows7_32bit)
+    assert not os.path.exists(get_index_path(pml_path_windows7_32bit))
+
+
 def test_processes_windows_10_64bit(pml_reader_windows10_64bit):
     processes = pml_reader_windows10_64bit.processes()
     assert 25 == len(processes)
@@ -226,3 +828,107 @@ def test_date_parsing(csv_reader_windows10_64bit, pml_reader_windows10_64bit):
     csv_event1 = next(csv_reader_windows10_64bit)
     csv_date1 = parse(csv_event1["Date & Time"]) + timedelta(microseconds=parse(csv_event1["Time of Day"]).microsecond)
     assert pml_date1 == csv_date1
+
+
+@pytest.mark.parametrize("make_stream", [BytesIO, BufferStream], ids=["stream", "buffer"])
+def test_read_utf16(make_stream):
+    # "A" and "\u0100" together have two null bytes at an odd offset, which are not a terminator
+    data = u"A\u0100".encode("UTF-16le") + b"\x00\x00" + u"next".encode("UTF-16le")
+    stream = make_stream(data)
+    assert read_utf16(stream) == u"A\u0100"
+    assert stream.tell() == 6
+    assert read_utf16(stream) == u"next"  # terminated by the end of the stream
+    assert stream.tell() == len(data)
+
+    stream = make_stream(data)
+    assert read_utf16(stream, 8) == u"A\u0100"
+    assert stream.tell() == 8  # the rest of the field is skipped
+    assert read_utf16(make_stream(data), 2) == u"A"
+
+    multisz_data = u"a=1\x00b=2\x00\x00".encode("UTF-16le") + b"rest"
+    stream = make_stream(multisz_data)
+    assert read_utf16_multisz(stream) == [u"a=1", u"b=2"]
+    assert stream.tell() == len(multisz_data) - len(b"rest")
+    stream = make_stream(multisz_data)
+    assert read_utf16_multisz(stream, 8) == [u"a=1"]
+    assert stream.tell() == 8
+    assert read_utf16_multisz(make_stream(b"\x00\x00\x00\x00")) == [u""]
+
+    long_string = u"C:\\Windows\\System32\\" * 1000  # longer than the first chunk of a read without a size
+    assert read_utf16(make_stream(long_string.encode("UTF-16le") + b"\x00\x00")) == long_string
+
+    assert decode_utf16(memoryview(data)) == u"A\u0100"
+    assert decode_utf16_multisz(memoryview(multisz_data)[:-4]) == [u"a=1", u"b=2"]
+
+
+def test_lazy_strings_table(pml_logs_windows7_32bit):
+    data = pml_logs_windows7_32bit
+    stream = BytesIO(data)
+    table_start = Header(stream).strings_table_offset
+    stream.seek(table_start)
+    strings_table = StringsTable(stream)
+    uncached_strings_table = StringsTable(BytesIO(data[table_start:]), cache=False)
+
+    # Decode all the strings of the table for reference
+    number_of_strings = unpack_from("<I", data, table_start)[0]
+    expected_strings = []
+    for i in range(number_of_strings):
+        string_offset = table_start + unpack_from("<I", data, table_start + 4 + 4 * i)[0]
+        string_size = unpack_from("<I", data, string_offset)[0]
+        raw_string = data[string_offset + 4:string_offset + 4 + string_size]
+        expected_strings.append(raw_string.decode("UTF-16le").split(u"\x00")[0])
+
+    stream.seek(0)
+    assert len(strings_table) == number_of_strings
+    assert strings_table[number_of_strings - 1] == expected_strings[-1]
+    assert list(strings_table) == expected_strings
+    assert list(uncached_strings_table) == expected_strings
+    assert stream.tell() == 0  # reading a string doesn't move the stream
+    with pytest.raises(IndexError):
+        _ = strings_table[number_of_strings]
+
+
+def test_lazy_process_table(pml_path_windows7_32bit, pml_reader_windows7_32bit):
+    pml_reader = ProcmonLogsReader(pml_path_windows7_32bit)
+    process_table = pml_reader._struct_readear._process_table
+    assert dict.__len__(process_table) == 0  # no process is decoded when the log is opened
+    process = pml_reader[0].process
+    assert dict.__len__(process_table) == 1
+    assert "modules" not in process.__dict__
+    number_of_modules = process._count_modules()
+
+    expected_processes = pml_reader_windows7_32bit.processes()
+    assert len(process_table) == len(expected_processes)
+    assert process in expected_processes
+    assert len(process.modules) == number_of_modules
+
+    other_process = pml_reader[-1].process
+    pml_reader.close()
+    assert "modules" in other_process.__dict__  # loaded before the file was closed
+    assert pickle.loads(pickle.dumps(other_process)) == other_process
+
+
+def test_events_offsets_array(pml_logs_windows7_32bit, monkeypatch):
+    data = pml_logs_windows7_32bit
+    header = Header(BytesIO(data))
+    array_start = header.events_offsets_array_offset
+    expected_offsets = [unpack_from("<I", data, array_start + 5 * i)[0] for i in range(header.number_of_events)]
+    expected_flags = [unpack_from("B", data, array_start + 5 * i + 4)[0] for i in range(header.number_of_events)]
+
+    def read_events_offsets():
+        stream = BytesIO(data)
+        stream.seek(array_start)
+        return EventOffsetsArray.read(stream, header.process_table_offset - array_start, header.number_of_events)
+
+    events_offsets_arrays = [read_events_offsets()]
+    monkeypatch.setattr(stream_logs_format, "numpy", None)  # the fallback without numpy
+    events_offsets_arrays.append(read_events_offsets())
+    for events_offsets in events_offsets_arrays:
+        assert len(events_offsets) == header.number_of_events
+        assert list(events_offsets) == expected_offsets
+        assert list(events_offsets.flags) == expected_flags
+        assert type(events_offsets[-1]) is int and events_offsets[-1] == expected_offsets[-1]
+        events_offsets_slice = events_offsets[100:-100:3]
+        assert isinstance(events_offsets_slice, EventOffsetsArray)
+        assert list(events_offsets_slice) == expected_offsets[100:-100:3]
+        assert list(events_offsets_slice.flags) == expected_flags[100:-100:3]